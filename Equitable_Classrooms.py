@@ -1,14 +1,32 @@
-from numpy.core.numeric import isclose
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
 import pandas as pd
-from pandas import ExcelWriter
 import numpy as np
-import math
-import random
-from pandas.core.arrays.integer import Int32Dtype
-from pandas.core.indexes.api import get_objs_combined_axis
+from openpyxl import Workbook
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
 
 SCHOOL_FILE= 'Grade Level_20210509_Names_Removed.xls'
 
+# Where the command line writes next year's class lists unless told otherwise.
+OUTPUT_FILE = 'NextYrsClasses.xlsx'
+
+# Class lists are written as an Excel workbook, or as a folder of CSV files with one file per sheet.  Every class gets a sheet named by class_sheet_name() and the SUMMARY_SHEET holds each class's statistics.
+OUTPUT_FORMATS = ['xlsx', 'csv']
+SUMMARY_SHEET = 'Summary'
+
+# Converted SIS exports are cached here, one folder per content hash of the export, so repeated runs skip parsing the legacy .xls.
+CACHE_DIR = '.ingest_cache'
+
+# Version of the converted data in the cache.  Raise it whenever convert_attribs() or categorize_attendance() changes what they produce, so exports cached by older code are parsed again.
+CACHE_VERSION = 1
+
 # The file provided by the school indicates students' previous grade level.
 EXIT_GRADES= ['KG', '01', '02', '03', '04', '05']
 
@@ -35,8 +53,15 @@ ALL_CATEGORIES = [BINARY_CATEGORIES + CLUSTERED_CATEGORIES + NOMINAL_CATEGORIES
 # This file defines acceptable clusters for special education based on staffing resources. 
 CLUSTER_FILE = 'SPED_Clusters.xlsx'
 
-# This file defines acceptable clusters for race affinity groups. 
-CLUSTER_FILE_FLOAT = 'Race_Affinity_Clusters.xlsx'
+# Acceptable cluster patterns keyed by cluster file, then by number of classes.  Each entry is a set of sorted tuples so a candidate class split is checked with one hash lookup.  Populated once by load_cluster_rules().
+CLUSTER_RULES = {}
+
+# The same patterns as 2-D integer arrays keyed by (cluster file, number of classes), for measuring how far a class split is from the nearest pattern.
+CLUSTER_TABLES = {}
+
+# Race affinity rule, for race groups of any size: every class has either none of a grade's students of one race or at least AFFINITY_MIN of them, unless the grade has fewer than AFFINITY_MIN, and the counts of one race differ by at most AFFINITY_SPREAD between classes.  Race_Affinity_Clusters.xlsx, the school's old affinity sheets, is no longer read and is only kept for reference; every pattern in it follows this rule.
+AFFINITY_MIN = 2
+AFFINITY_SPREAD = 3
 
 # Tolerances set by end user, but established in this instance by collaborating school administrator (client).  Increasing these values increases runtime, but increases balance. 
 GENDER_TOL = .20
@@ -45,22 +70,102 @@ LAP_TOL = .25
 ATTENDANCE_TOL = .3
 IRLA_TOL = .25
 
+# Each tolerance bounds the spread (most minus least) of one per-class average within a grade.  The small allowance keeps float round-off from failing a spread that sits exactly on its tolerance, as math.isclose allowed.
+ROUNDING_ALLOWANCE = 1e-9
+TOLERANCES = {'Gender': GENDER_TOL, '504 - 2020-2021': IEP_TOL, 'LAP Indicator - 2020-2021': LAP_TOL, 'Attn % - 2020-2021': ATTENDANCE_TOL, 'IRLA-Score - 2020-2021': IRLA_TOL}
+
+# Every check a division of a grade must pass, in the order solver metrics and violation_parts() report them.
+CHECK_NAMES = list(TOLERANCES) + ['check_clusters', 'affinity_diversity_check']
+
+# Columns of the student matrix built once per grade by encode_grade().  'IRLA scored' flags students who have a test score and 'Students' is always 1, so class sizes come out of the same pass as every other sum.
+ENCODED_COLUMNS = BINARY_CATEGORIES + CLUSTERED_CATEGORIES + ATTENDANCE_CATEGORY + ['IRLA-Score - 2020-2021', 'IRLA scored'] + RACES + ['Students']
+ENCODED_INDEX = {name: i for i, name in enumerate(ENCODED_COLUMNS)}
+
+# Columns of the per-class statistics matrix returned by grade_stats().  Balance categories are class averages; clustered categories and races are class counts.
+STAT_COLUMNS = BINARY_CATEGORIES + CLUSTERED_CATEGORIES + ATTENDANCE_CATEGORY + ['IRLA-Score - 2020-2021'] + RACES
+STAT_INDEX = {name: i for i, name in enumerate(STAT_COLUMNS)}
+AVERAGED_CATEGORIES = BINARY_CATEGORIES + ATTENDANCE_CATEGORY
+
+# One record per student in the solver's compact student store.  'row' is the student's position in the student body dataframe and is only used to map results back when they are written out.  'Grade' is a position in EXIT_GRADES and 'Race' a position in RACES, -1 for anything else.
+STUDENT_DTYPE = np.dtype([('row', np.int32), ('Grade', np.int8)] + [(category, np.int8) for category in BINARY_CATEGORIES + CLUSTERED_CATEGORIES] + [(ATTENDANCE_CATEGORY[0], np.float64), ('IRLA-Score - 2020-2021', np.float64), ('Race', np.int8)])
+COUNTED_CATEGORIES = CLUSTERED_CATEGORIES + RACES
+
+# Solver used by main(): 'cluster' places clustered students by pattern first and then balances everyone else, 'batch' scores up to BATCH_SIZE random candidates per NumPy call, 'local' improves one division by simulated annealing, and 'rejection' tries one candidate at a time.
+SOLVER_MODE = 'cluster'
+BATCH_SIZE = 2000
+
+# Most bytes of encoded students one 'batch' call gathers (candidates x students x ENCODED_COLUMNS floats).  Large grades get fewer candidates per call so each worker stays within it.
+BATCH_MEMORY = 64 * 2**20
+
+# Simulated annealing settings for the 'local' and 'cluster' solvers.  The temperature cools geometrically from the start to the end value over ANNEAL_STEPS moves, then the search restarts from a new random division.
+ANNEAL_STEPS = 100000
+ANNEAL_START_TEMP = 1.0
+ANNEAL_END_TEMP = 0.001
+
+# How many times the 'cluster' solver re-picks patterns when its greedy placement runs out of room.
+PLACEMENT_ATTEMPTS = 100
+
+# How often, in annealing steps, a solver checks whether another worker already solved its grade.
+STOP_CHECK_INTERVAL = 1000
+
+# Worker processes for solving grades in parallel, with RACING_SEEDS independently seeded solver runs raced against each other for every grade.  0 workers solves the grades one after another in this process.
+PARALLEL_WORKERS = 0
+RACING_SEEDS = 1
+
+# Seconds between progress lines (and trace snapshots) from SolverMetrics.
+PROGRESS_INTERVAL = 5.0
+
+# Seconds between checkpoint saves while a grade is being searched.  A checkpoint is also saved whenever a grade is solved.
+CHECKPOINT_INTERVAL = 30.0
+
+# Largest value a student can have in each averaged category: the yes/no categories are 0 or 1 and attendance falls into groups 0, 1 and 2.  Used to bound the best balance any division can reach.
+CATEGORY_MAXIMUMS = {'Gender': 1, '504 - 2020-2021': 1, 'LAP Indicator - 2020-2021': 1, 'Attn % - 2020-2021': 2}
+
+# Weight of every check in CHECK_NAMES when a search on a budget ranks divisions that miss some checks.  A balance check counts how many tolerances its spread is over, a cluster check how many students are out of place.
+CHECK_WEIGHTS = {name: 1.0 for name in CHECK_NAMES}
+
+# Default search budget per grade, in seconds and in attempts.  None means search until every check passes.
+TIME_BUDGET = None
+ATTEMPT_BUDGET = None
+
+# Settings solve_school() uses for anything its config leaves out.
+DEFAULT_CONFIG = {'solver': SOLVER_MODE,                 # a key of SOLVERS
+                  'tolerances': TOLERANCES,              # merged into TOLERANCES, so a partial dictionary only changes the tolerances it names
+                  'workers': PARALLEL_WORKERS,           # worker processes; 0 solves the grades one after another
+                  'seeds': RACING_SEEDS,                 # seeded runs raced per grade when solving in parallel
+                  'metrics': None,                       # a SolverMetrics counting attempts, time and check failures
+                  'check_feasibility': True,             # raise InfeasibleError before searching if analyze_feasibility() finds a problem
+                  'time_budget': TIME_BUDGET,            # seconds per grade before the best division is kept
+                  'attempt_budget': ATTEMPT_BUDGET,      # attempts per grade before the best division is kept
+                  'weights': CHECK_WEIGHTS,              # how a budget ranks divisions that miss some checks
+                  'on_grade': None,                      # called with each exit grade, its class numbers and grade_stats() once solved
+                  'seed': None,                          # seed of every random step; a fresh one is drawn when None
+                  'checkpoint': None,                    # file the run's progress is saved to
+                  'resume': False}                       # continue from the checkpoint file if it exists
+
+# Share of proposals that move one student instead of swapping two.  Moves are only made from a class with one extra student, so class sizes stay as even as np.array_split makes them.
+MOVE_SHARE = 0.2
+
+# How many students, per repair round, are also tried in two-student swaps with everyone in another class: those whose best single move would help most.
+REPAIR_SWAP_CANDIDATES = 20
+
 
 def convert_attribs(student_body):
     """Clean white space from student body file.  Convert 'yes/no' or 'male/female' categories to 1's and 0's.  Convert attendance category from string type % to float type %."""
 
-    # Trim all whitespace from dataframe.
-    student_body.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    # Trim whitespace, and the zero-width spaces the SIS export puts in front of many values, from every text column.
+    for column in student_body.select_dtypes(exclude='number').columns:
+        student_body[column] = student_body[column].str.replace('\u200b', '', regex=False).str.strip()
 
-    # Change 'yes/no' categories to '1' or '0'.
+    # Change 'yes/no' categories to '1' or '0'.  Missing values count as 'no'.
     student_body['SPED'] = np.where(student_body['SPED'] == 'Yes', 1, 0)
-    student_body['HCP - 2020-2021'] = np.where(student_body['HCP - 2020-2021'].str.contains('Yes'), 1, 0)
-    student_body['504 - 2020-2021'] = np.where(student_body['504 - 2020-2021'].str.contains('Yes'), 1, 0)
-    student_body['Gender'] = np.where(student_body['Gender'].str.contains('Male'), 1, 0)
-    student_body['LAP Indicator - 2020-2021'] = np.where(student_body['LAP Indicator - 2020-2021'].str.contains('Yes'), 1, 0)
+    student_body['HCP - 2020-2021'] = np.where(student_body['HCP - 2020-2021'].str.contains('Yes', regex=False, na=False), 1, 0)
+    student_body['504 - 2020-2021'] = np.where(student_body['504 - 2020-2021'].str.contains('Yes', regex=False, na=False), 1, 0)
+    student_body['Gender'] = np.where(student_body['Gender'].str.contains('Male', regex=False, na=False), 1, 0)
+    student_body['LAP Indicator - 2020-2021'] = np.where(student_body['LAP Indicator - 2020-2021'].str.contains('Yes', regex=False, na=False), 1, 0)
     
     # Convert string attendance % to float.
-    student_body['Attn % - 2020-2021'] = student_body['Attn % - 2020-2021'].str.replace('%', '').astype(float)
+    student_body['Attn % - 2020-2021'] = pd.to_numeric(student_body['Attn % - 2020-2021'].astype(str).str.rstrip('%'), errors='coerce')
     
     student_body = categorize_attendance(student_body)
 
@@ -92,26 +197,85 @@ def num_per_grade(all_grades):
     return sizes
 
     
-def initialize_data():
-    """Import student data from file and create a dataframe, call function to convert string data to ints and floats, and group students by grade. """
-    
-    
-    # Import student data from school district program output. 
-    all_students = pd.read_excel(SCHOOL_FILE, index_col = [1], header=[10])
+def file_digest(path):
+    """Return the SHA-256 hash of a file's contents."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_student_cache(student_body, cache_path):
+    """Write a converted student body to a cache folder: one .npy file per column, text columns as fixed-width strings with a missing-value mask, and a columns.json manifest.  The folder is written under a temporary name and renamed into place so a half-written cache is never read."""
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+    manifest = {'index': student_body.index.name, 'columns': []}
+
+    columns = [('index', student_body.index.to_series())] + [(name, student_body[name]) for name in student_body.columns]
+    for position, (name, column) in enumerate(columns):
+        text = not pd.api.types.is_numeric_dtype(column)
+        if text:
+            np.save(os.path.join(staging, f'{position}_missing.npy'), column.isna().to_numpy())
+            values = column.fillna('').astype(str).to_numpy(dtype=str)
+        else:
+            values = column.to_numpy()
+        np.save(os.path.join(staging, f'{position}.npy'), values)
+        manifest['columns'].append({'name': name, 'text': text})
+
+    with open(os.path.join(staging, 'columns.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    try:
+        os.replace(staging, cache_path)
+    except OSError:
+        # Another run cached the same export first.
+        shutil.rmtree(staging, ignore_errors=True)
+
+def load_student_cache(cache_path):
+    """Read a converted student body back from a cache folder written by save_student_cache.  Numeric columns are memory-mapped copy-on-write rather than read into memory, so the frame can be edited without touching the cache."""
+
+    with open(os.path.join(cache_path, 'columns.json')) as f:
+        manifest = json.load(f)
+
+    columns = {}
+    for position, column in enumerate(manifest['columns']):
+        if column['text']:
+            values = pd.Series(np.load(os.path.join(cache_path, f'{position}.npy')), dtype=object)
+            values[np.load(os.path.join(cache_path, f'{position}_missing.npy'))] = np.nan
+        else:
+            values = np.load(os.path.join(cache_path, f'{position}.npy'), mmap_mode='c')
+        columns[column['name']] = values
 
-    # Convert string categories to integers and floats.
+    index = pd.Index(columns.pop('index'), name=manifest['index'])
+    return pd.DataFrame({name: np.asarray(values) for name, values in columns.items()}, index=index, copy=False)
+
+def read_school_file(school_file=SCHOOL_FILE, cache_dir=CACHE_DIR, digest=None):
+    """Import student data from the school district program output and return it as one dataframe with string data converted to ints and floats.  The converted data is cached under cache_dir by CACHE_VERSION and the export's content hash, so only the first run on an export parses it; pass cache_dir=None to always parse, and digest if the export's file_digest() is already known."""
+
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f'v{CACHE_VERSION}', digest or file_digest(school_file))
+        if os.path.isdir(cache_path):
+            return load_student_cache(cache_path)
+
+    all_students = pd.read_excel(school_file, index_col = [1], header=[10])
     conv_students = convert_attribs(all_students)
 
-    # Group students by grade.
-    gradegroups = conv_students.groupby(conv_students.Grade)
-    kg = gradegroups.get_group('KG')
-    firstg = gradegroups.get_group('01')
-    secondg = gradegroups.get_group('02')
-    thirdg = gradegroups.get_group('03')
-    fourthg = gradegroups.get_group('04')
-    fifthg = gradegroups.get_group('05')
+    if cache_dir is not None:
+        save_student_cache(conv_students, cache_path)
+    return conv_students
+
+def group_by_grade(student_body):
+    """Group a converted student body by exit grade and return a dictionary of each exit grade's students.  Grades outside EXIT_GRADES are left out."""
 
-    students_by_grade = [kg, firstg, secondg, thirdg, fourthg, fifthg]
+    return {grade: students for grade, students in student_body.groupby('Grade') if grade in EXIT_GRADES}
+
+def initialize_data(school_file=SCHOOL_FILE):
+    """Import student data from file and create a dataframe, call function to convert string data to ints and floats, and group students by grade. """
+
+    gradegroups = group_by_grade(read_school_file(school_file))
+    students_by_grade = [gradegroups[grade] for grade in EXIT_GRADES]
 
     return students_by_grade
     
@@ -131,391 +295,1464 @@ def how_many_classes(st_by_grade):
     return num_classes
 
 
-def shuffle(grades_to_shuffle):
-    """Shuffle students randomly and return a list of dataframes of students grouped by grade.""" 
+def classes_from_labels(grade, labels, n_classes):
+    """Divide one grade of students into classes according to their class labels and return the classes of students."""
 
-    shuffled = []
-    for grades in grades_to_shuffle:
-        random = grades.sample(frac=1)
-        shuffled.append(random)
-    return shuffled
+    return [grade.iloc[np.flatnonzero(labels == c)] for c in range(n_classes)]
 
-def divide_into_classes(grades, n_classes):
-    """Split all students in the same grade by the number of classes which was provided by the school administrator.""" 
-    
-    next_grades = []
-    i = 0
-    for x in grades:
-        num = n_classes[i]
-        nextgrade = np.array_split(x, num)
-        next_grades.append(nextgrade)
-        i+=1
-    return next_grades
+def categorize_attendance(all_students):
+    """Convert student body attendance from % to three categories."""
 
-def missing_scores_school(all_classes_by_grade):
-    """Fills missing test scores of each grade in the whole student body with the average test score of that grade and returns the whole student body file cleaned.  Only conducted once."""
+    all_students.loc[all_students['Attn % - 2020-2021'] > 90, 'Attn % - 2020-2021'] = 0
+    all_students.loc[all_students['Attn % - 2020-2021'] > 80, 'Attn % - 2020-2021'] = 1 
+    all_students.loc[all_students['Attn % - 2020-2021'] > 3, 'Attn % - 2020-2021'] = 2
+    return all_students
 
-    ''' TODO ask client whether or not empty scores should use the average of the other test scores or use a lower score due to the fact that it looks like those who have missing scores are underperforming in other areas as well'''
+def class_sizes(n_students, n_classes):
+    """Return the class sizes np.array_split produces when dividing a grade: the first (n_students % n_classes) classes get one extra student."""
 
-    for grade in all_classes_by_grade:
-        for cls in grade:
-            cls = cls.fillna(cls.mean())
+    sizes = np.full(n_classes, n_students // n_classes)
+    sizes[:n_students % n_classes] += 1
+    return sizes
 
-    return all_classes_by_grade
+def split_labels(order, n_classes):
+    """Return the class label of every student when the students, taken in the given order, are divided into classes the same way np.array_split divides them."""
 
-def reshuffle_one_grade(grade):
-    """Reshuffle one grade of students and return the grade student body."""
+    labels = np.empty(len(order), dtype=np.int32)
+    labels[order] = np.repeat(np.arange(n_classes, dtype=np.int32), class_sizes(len(order), n_classes))
+    return labels
 
-    num = len(grade)
-    reshuffled = grade.loc[random.sample(list(grade.index),num)]
+def build_student_store(student_body):
+    """Copy the columns the solver needs out of a converted student body into a structured array of STUDENT_DTYPE records, one per student, in the dataframe's row order."""
 
-    return reshuffled
+    store = np.zeros(len(student_body), dtype=STUDENT_DTYPE)
+    store['row'] = np.arange(len(student_body))
+    store['Grade'] = pd.Index(EXIT_GRADES).get_indexer(student_body['Grade'])
+    for category in BINARY_CATEGORIES + CLUSTERED_CATEGORIES + ATTENDANCE_CATEGORY + ['IRLA-Score - 2020-2021']:
+        store[category] = student_body[category].to_numpy(dtype=float)
+    store['Race'] = pd.Index(RACES).get_indexer(student_body['Race'])
+    return store
 
-def divide_one_grade(grade, n_classes):
-    """Divide one grade of students by the number of classes and return the classes of students."""
+def encode_grade(students):
+    """Encode one grade of student store records once into a float matrix with one row per student and one column per entry of ENCODED_COLUMNS, which is all class statistics are computed from."""
 
-    classes= np.array_split(grade, n_classes)
-    return classes
+    n_students = len(students)
+    encoded = np.zeros((n_students, len(ENCODED_COLUMNS)))
 
-def missing_scores_gradelevel(grade):
-    """Fill missing test scores of each class in one grade with the average of the one class and return the dataframe of the grade."""
+    for category in BINARY_CATEGORIES + CLUSTERED_CATEGORIES + ATTENDANCE_CATEGORY:
+        encoded[:, ENCODED_INDEX[category]] = np.nan_to_num(students[category])
 
-    ''' TODO ask client wether or not empty scores should use the average of the other test scores, or use a lower score due to the fact that it looks like those who have missing scores are underperforming in other areas as well.'''
-    
-    for cls in grade:
-        cls = cls.fillna(cls.mean())
-    
-    return grade
+    # Missing test scores count as 0 in the sum and are left out of the 'IRLA scored' count used to average it.
+    irla = students['IRLA-Score - 2020-2021'].astype(float)
+    scored = ~np.isnan(irla)
+    encoded[:, ENCODED_INDEX['IRLA-Score - 2020-2021']] = np.where(scored, irla, 0)
+    encoded[:, ENCODED_INDEX['IRLA scored']] = scored
 
-def categorize_attendance(all_students):
-    """Convert student body attendance from % to three categories."""
+    # Race is stored as a category code and expanded to one column per race.  Races outside RACES get no column.
+    known = students['Race'] >= 0
+    encoded[np.flatnonzero(known), ENCODED_INDEX[RACES[0]] + students['Race'][known]] = 1
 
-    all_students.loc[all_students['Attn % - 2020-2021'] > 90, 'Attn % - 2020-2021'] = 0
-    all_students.loc[all_students['Attn % - 2020-2021'] > 80, 'Attn % - 2020-2021'] = 1 
-    all_students.loc[all_students['Attn % - 2020-2021'] > 3, 'Attn % - 2020-2021'] = 2
-    return all_students
+    encoded[:, ENCODED_INDEX['Students']] = 1
+    return encoded
 
-def calculate(classes_to_check):
-    """For every class in every grade, calc averages and other data, and store them in a list of new dataframes and return the list. This only runs once."""
-
-    gender_list = []
-    iep_list = []
-    lap_list = []
-    sped_list = []
-    hcp_list = []
-    grade_list = []
-    att_list = []
-    irla_list = []
-    asian_list = []
-    black_list = []
-    hispanic_list =[]
-    multi_list = []
-    native_list = []
-    pi_list = []
-    white_list = []
-
-    racedf = pd.DataFrame(columns = RACES)
-
-    for grade_levels in classes_to_check:
-        i =0
-        for c in grade_levels:
-            iep_calc = c['504 - 2020-2021'].sum()/len(c)
-            iep_list.append(iep_calc)
-            att_calc = c['Attn % - 2020-2021'].sum()/len(c)
-            att_list.append(att_calc)
-            gender_calc = c['Gender'].sum()/len(c)
-            gender_list.append(gender_calc)
-            lap_calc = c['LAP Indicator - 2020-2021'].sum()/len(c)
-            lap_list.append(lap_calc)
-            sped_total = c['SPED'].sum()
-            sped_list.append(sped_total)
-            hcp_total = c['HCP - 2020-2021'].sum()
-            hcp_list.append(hcp_total)
-            irla_calc = c['IRLA-Score - 2020-2021'].sum()/len(c)
-            irla_list.append(irla_calc)
-            race_int= c['Race'].value_counts()
-            racedf = racedf.append(race_int, ignore_index=True)
-            racedf = racedf.fillna(0)
-            asian_list = racedf['Asian'].values.tolist()
-            black_list = racedf['Black'].to_list()
-            hispanic_list = racedf['Hispanic'].to_list()
-            multi_list = racedf['Multiple'].to_list()
-            native_list = racedf['Native'].to_list()
-            pi_list = racedf['Pacific Islander'].to_list()
-            white_list = racedf['White'].to_list()                      
-            g = c.iloc[0]['Grade']
-            grade_list.append(g)
-
-        i= i +1
-                
-        
-    # Instantiate and populate a df for calculations.
-    calc = pd.DataFrame(columns=ALL_CATEGORIES,index=grade_list).rename_axis('Classes')
-    calc['Gender']= gender_list
-    calc['504 - 2020-2021'] = iep_list
-    calc['LAP Indicator - 2020-2021'] = lap_list
-    calc['SPED'] = sped_list
-    calc['HCP - 2020-2021'] = hcp_list
-    calc['Attn % - 2020-2021'] = att_list
-    calc['IRLA-Score - 2020-2021'] = irla_list
-    calc['Asian'] = asian_list
-    calc['Black'] = black_list
-    calc['Hispanic'] = hispanic_list
-    calc['Multiple'] = multi_list
-    calc['Native'] = native_list
-    calc['Pacific Islander'] = pi_list
-    calc['White'] = white_list
-
-    # Create new dfs for each grade's calculations.
-    calc1 = calc.loc[calc.index == EXIT_GRADES[0]]
-    calc2 = calc.loc[calc.index == EXIT_GRADES[1]]
-    calc3 = calc.loc[calc.index == EXIT_GRADES[2]]
-    calc4 = calc.loc[calc.index == EXIT_GRADES[3]]
-    calc5 = calc.loc[calc.index == EXIT_GRADES[4]]
-    calc6 = calc.loc[calc.index == EXIT_GRADES[5]]
-    calc_dfs = [calc1, calc2, calc3, calc4, calc5, calc6]
-
-    return calc_dfs
+def stats_from_sums(sums):
+    """Turn per-class sums of the encoded columns into the per-class statistics matrix.  Works on one grade (classes x columns) or on a batch of candidates (candidates x classes x columns)."""
 
-def check_clusters(grade_to_check):
-    """Determine if the special education and gifted student of this grade fall into acceptable clusters defined by school."""
+    stats = np.empty(sums.shape[:-1] + (len(STAT_COLUMNS),))
+    sizes = sums[..., ENCODED_INDEX['Students']]
+    for category in AVERAGED_CATEGORIES:
+        stats[..., STAT_INDEX[category]] = sums[..., ENCODED_INDEX[category]] / sizes
+    for category in COUNTED_CATEGORIES:
+        stats[..., STAT_INDEX[category]] = sums[..., ENCODED_INDEX[category]]
 
-    nclasses = len(grade_to_check)   
-    clusters_good = True
-    sped_clus_good = True
-    hicap_clus_good = True
-    school_clusters = pd.read_excel(CLUSTER_FILE, header=None, sheet_name=((nclasses)-2))
-    cluster_lists = school_clusters.values.tolist()
+    # Averaging over scored students only gives the same class average as filling missing scores with it.
+    scored = sums[..., ENCODED_INDEX['IRLA scored']]
+    irla = sums[..., ENCODED_INDEX['IRLA-Score - 2020-2021']]
+    stats[..., STAT_INDEX['IRLA-Score - 2020-2021']] = np.divide(irla, scored, out=np.zeros_like(irla), where=scored > 0)
 
-    # If there's only one class, clusters are not applicable. 
+    return stats
+
+def class_sums(encoded, labels, n_classes):
+    """Sum every encoded column per class in a single np.bincount pass over the class-label vector and return a classes x ENCODED_COLUMNS matrix."""
+
+    n_columns = encoded.shape[1]
+    bins = (labels[:, None] * n_columns + np.arange(n_columns)).ravel()
+    sums = np.bincount(bins, weights=encoded.ravel(), minlength=n_classes * n_columns)
+    return sums.reshape(n_classes, n_columns)
+
+def grade_stats(encoded, labels, n_classes):
+    """For every class in one grade, calc averages and counts from the class-label vector and return the classes x STAT_COLUMNS matrix."""
+
+    return stats_from_sums(class_sums(encoded, labels, n_classes))
+
+def stat_spreads(stats, tolerances=TOLERANCES):
+    """Return the spread (most minus least across classes) of every category that has a tolerance."""
+
+    columns = [STAT_INDEX[category] for category in tolerances]
+    balanced = stats[..., columns]
+    return balanced.max(axis=-2) - balanced.min(axis=-2)
+
+def tolerance_checks(stats, tolerances=TOLERANCES):
+    """Return one true/false per tolerance, in the order of the tolerances, for whether that category is balanced across the classes."""
+
+    return stat_spreads(stats, tolerances) <= np.array(list(tolerances.values())) + ROUNDING_ALLOWANCE
+
+def within_tolerances(stats, tolerances=TOLERANCES):
+    """Determine if every balanced category of this grade is within its tolerance and return true or false."""
+
+    return bool(np.all(tolerance_checks(stats, tolerances)))
+
+def batch_stats(encoded, orders, n_classes):
+    """For a batch of candidate student orders (candidates x students), divide every candidate into classes and compute all their per-class statistics at once.  Returns a candidates x classes x STAT_COLUMNS array."""
+
+    bounds = np.cumsum(class_sizes(orders.shape[1], n_classes))[:-1]
+    sums = np.add.reduceat(encoded[orders], np.r_[0, bounds], axis=1)
+    return stats_from_sums(sums)
+
+def pattern_mask(counts, cluster_file):
+    """Return, for every row of per-class counts (candidates x classes), whether its sorted counts are an acceptable pattern in the cluster file."""
+
+    nclasses = counts.shape[-1]
+
+    # If there's only one class, clusters are not applicable.
     if nclasses == 1:
-        return clusters_good
-        pass
-    else: 
-        sped = sorted(grade_to_check['SPED'].values.tolist())
-        sped = [i[0] for i in sped]
-        hcp = sorted(grade_to_check['HCP - 2020-2021'].values.tolist())
-        hcp = [i[0] for i in hcp]
-        if sped in cluster_lists:
-            sped_clus_good = True
-        else:
-            sped_clus_good = False
-        if hcp in cluster_lists:
-            hicap_clus_good = True
+        return np.ones(counts.shape[:-1], dtype=bool)
+
+    table = pattern_table(cluster_file, nclasses)
+    if len(table) == 0 or counts.size == 0:
+        return np.zeros(counts.shape[:-1], dtype=bool)
+
+    # View each sorted row of counts as one opaque value so the whole batch is matched against the patterns with np.isin, exactly for any number of classes.
+    row_type = np.dtype((np.void, nclasses * np.dtype(np.int64).itemsize))
+    rows = np.ascontiguousarray(np.sort(counts.astype(np.int64), axis=-1).reshape(-1, nclasses))
+    matched = np.isin(rows.view(row_type).ravel(), np.ascontiguousarray(table).view(row_type).ravel())
+    return matched.reshape(counts.shape[:-1])
+
+def batch_cluster_mask(stats):
+    """Batch version of check_clusters: one true/false per candidate for whether its special education and gifted students fall into acceptable clusters."""
+
+    mask = np.ones(stats.shape[0], dtype=bool)
+    for category in CLUSTERED_CATEGORIES:
+        mask &= pattern_mask(stats[..., STAT_INDEX[category]], CLUSTER_FILE)
+    return mask
+
+def batch_affinity_mask(stats):
+    """Batch version of affinity_diversity_check: one true/false per candidate for whether every race group meets the affinity rule."""
+
+    return ~affinity_distance(race_counts(stats)).any(axis=-1)
+
+def pattern_distance(counts, cluster_file):
+    """Return, for every row of per-class counts (... x classes), how many students would have to change classes to reach the nearest acceptable pattern in the cluster file.  0 means the row is an acceptable pattern."""
+
+    nclasses = counts.shape[-1]
+
+    # If there's only one class, clusters are not applicable.
+    if nclasses == 1:
+        return np.zeros(counts.shape[:-1])
+
+    rows = np.sort(counts, axis=-1)
+    totals = rows.sum(axis=-1)
+    table = pattern_table(cluster_file, nclasses)
+
+    # Moves never change how many students a category has, so only patterns with the same total can be reached.
+    distances = np.abs(rows[..., None, :] - table).sum(axis=-1) / 2
+    distances = np.where(table.sum(axis=-1) == totals[..., None], distances, np.inf)
+    if distances.shape[-1] == 0:
+        return totals + 1
+    nearest = distances.min(axis=-1)
+    return np.where(np.isinf(nearest), totals + 1, nearest)
+
+def race_counts(stats):
+    """Return every race's per-class counts from per-class statistics, as a ... x RACES x classes array."""
+
+    # The races are the last, contiguous stat columns, so this is a view rather than a copy.
+    first = STAT_INDEX[RACES[0]]
+    return np.swapaxes(stats[..., first:first + len(RACES)], -1, -2)
+
+def affinity_distance(counts):
+    """Return, for every row of per-class counts of one race (... x classes), how many students would have to change classes to meet the affinity rule: the students in classes with some but fewer than AFFINITY_MIN of the race, or the seats missing there, whichever is fewer, plus how far the counts spread beyond AFFINITY_SPREAD.  0 means the row meets the rule.  Takes O(classes) per row whatever the group's size."""
+
+    # min(count, AFFINITY_MIN - count) is only positive for a class with some but too few of the race.
+    lonely = np.maximum(np.minimum(counts, AFFINITY_MIN - counts), 0).sum(axis=-1)
+    spread = np.maximum(counts.max(axis=-1) - counts.min(axis=-1) - AFFINITY_SPREAD, 0)
+
+    # A race group smaller than AFFINITY_MIN cannot form an affinity group anywhere.
+    return (lonely + spread) * (counts.sum(axis=-1) >= AFFINITY_MIN)
+
+def cluster_distance(stats):
+    """Return how far a grade's special education and gifted clusters are from the nearest pattern in the cluster file, and how far its race groups are from the affinity rule, following check_clusters and affinity_diversity_check.  0 means that check passes."""
+
+    clustered = np.swapaxes(stats[..., [STAT_INDEX[category] for category in CLUSTERED_CATEGORIES]], -1, -2)
+    return np.stack([pattern_distance(clustered, CLUSTER_FILE).sum(axis=-1), affinity_distance(race_counts(stats)).sum(axis=-1)], axis=-1)
+
+def violation_parts(stats, tolerances=TOLERANCES, clusters=True):
+    """Return the violation of every check in CHECK_NAMES order: how far each spread is over its tolerance, measured in tolerances, then the cluster and affinity distances in students.  0 means that check passes.  With clusters=False the cluster and affinity distances are taken to be 0, for searches that never change a clustered category's or race's count in any class."""
+
+    tol = np.array(list(tolerances.values()))
+    over = np.maximum(stat_spreads(stats, tolerances) - tol - ROUNDING_ALLOWANCE, 0) / tol
+    distances = cluster_distance(stats) if clusters else np.zeros(over.shape[:-1] + (2,))
+    return np.concatenate([over, distances], axis=-1)
+
+def violation_score(stats, tolerances=TOLERANCES):
+    """Combined violation of a grade: the sum of its violation_parts().  0 means every tolerance and cluster check passes."""
+
+    return violation_parts(stats, tolerances).sum(axis=-1)
+
+def stopped(stop):
+    """Return true if another worker has already solved this grade and set the stop event passed to the solver."""
+
+    return stop is not None and stop.is_set()
+
+class SolverMetrics:
+    """Counters for solver runs: attempts, seconds spent shuffling, computing statistics and checking, and how often each check in CHECK_NAMES failed out of how often it was checked.  The counts are kept per label, normally one exit grade, started by begin(), and as running totals across every label.  Takes a snapshot every interval seconds, printing it as a progress line if asked, and can write the snapshots as a JSON or CSV trace."""
+
+    def __init__(self, progress=False, interval=PROGRESS_INTERVAL):
+        self.progress = progress
+        self.interval = interval
+        self.attempts = 0
+        self.times = {'shuffle': 0.0, 'stats': 0.0, 'checks': 0.0}
+        self.failures = np.zeros(len(CHECK_NAMES), dtype=np.int64)
+        self.checked = np.zeros(len(CHECK_NAMES), dtype=np.int64)
+        self.started = self.last_report = time.perf_counter()
+        self.snapshots = []
+        self.begin('')
+
+    def begin(self, label):
+        """Start counting under a new label, such as the next grade.  The running totals carry on."""
+
+        self.label = label
+        self.label_started = time.perf_counter()
+        self.label_base = (self.attempts, dict(self.times), self.failures.copy(), self.checked.copy())
+
+    def add(self, attempts, failures, checked, shuffle_time=0.0, stats_time=0.0, check_time=0.0):
+        """Count attempts, per-check failures out of per-check checks, and time spent, then report if the interval has passed."""
+
+        self.attempts += attempts
+        self.failures += failures
+        self.checked += checked
+        self.times['shuffle'] += shuffle_time
+        self.times['stats'] += stats_time
+        self.times['checks'] += check_time
+        if time.perf_counter() - self.last_report >= self.interval:
+            self.report()
+
+    def merge(self, summary):
+        """Add the running totals of another run's summary, such as one from a worker process."""
+
+        total = summary['total']
+        self.attempts += total['attempts']
+        self.failures += [total['failures'][name] for name in CHECK_NAMES]
+        self.checked += [total['checked'][name] for name in CHECK_NAMES]
+        for phase, seconds in total['time'].items():
+            self.times[phase] += seconds
+
+    def counts(self, elapsed, attempts, times, failures, checked):
+        """Return one set of counts as a dictionary that can be written as JSON."""
+
+        return {'elapsed': elapsed,
+                'attempts': attempts,
+                'attempts_per_second': attempts / elapsed if elapsed else 0.0,
+                'time': times,
+                'failures': dict(zip(CHECK_NAMES, failures.tolist())),
+                'checked': dict(zip(CHECK_NAMES, checked.tolist()))}
+
+    def summary(self):
+        """Return the current label's counts, and under 'total' the running totals across every label, as a dictionary that can be written as JSON."""
+
+        now = time.perf_counter()
+        attempts, times, failures, checked = self.label_base
+        label_times = {phase: seconds - times[phase] for phase, seconds in self.times.items()}
+        summary = {'label': self.label, **self.counts(now - self.label_started, self.attempts - attempts, label_times, self.failures - failures, self.checked - checked)}
+        summary['total'] = self.counts(now - self.started, self.attempts, dict(self.times), self.failures, self.checked)
+        return summary
+
+    def report(self):
+        """Take a snapshot for the trace and print it as one progress line if progress is on."""
+
+        self.last_report = time.perf_counter()
+        snapshot = self.summary()
+        self.snapshots.append(snapshot)
+        if self.progress:
+            failing = ', '.join(f'{name} {snapshot["failures"][name] / checked:.0%}' for name, checked in snapshot['checked'].items() if checked)
+            times = ', '.join(f'{phase} {seconds:.1f}s' for phase, seconds in snapshot['time'].items())
+            print(f"{self.label}: {snapshot['attempts']} attempts, {snapshot['attempts_per_second']:.0f}/s ({times}); failing: {failing}; {self.attempts} attempts in all")
+
+    def write_trace(self, path):
+        """Write every snapshot to path: one flat row per snapshot if it ends in .csv, otherwise JSON with the snapshots and a final summary."""
+
+        if path.lower().endswith('.csv'):
+            rows = [{'label': snapshot['label'], 'elapsed': snapshot['elapsed'], 'attempts': snapshot['attempts'], 'attempts_per_second': snapshot['attempts_per_second'],
+                     **{f'time_{phase}': seconds for phase, seconds in snapshot['time'].items()},
+                     **{f'failed_{name}': count for name, count in snapshot['failures'].items()},
+                     **{f'checked_{name}': count for name, count in snapshot['checked'].items()},
+                     'total_elapsed': snapshot['total']['elapsed'], 'total_attempts': snapshot['total']['attempts']} for snapshot in self.snapshots]
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ['label'])
+                writer.writeheader()
+                writer.writerows(rows)
         else:
-            hicap_clus_good = False
-        clusters_good = hicap_clus_good and sped_clus_good
-        return clusters_good
-        
-def affinity_diversity_check(grade_to_check):
-    """Determine if the special education and gifted student of this grade fall into acceptable clusters defined by school and return true or false."""
+            with open(path, 'w') as f:
+                json.dump({'snapshots': self.snapshots, 'summary': self.summary()}, f, indent=2)
+
+class SearchBudget:
+    """Time and attempt limits for one grade's search, and the best division seen so far under a weighted violation score.  Solvers take it as their stop argument: is_set() turns true once the budget runs out or the outer stop event is set, the solvers offer() it the divisions they look at, and they mark() the point they have reached whenever due().  Attempts are counted through metrics.  on_best, if given, is called with every better division found, and on_mark with every point marked.  resume, a point on_mark was given, continues that search's budget and is where the solvers pick the search up."""
+
+    def __init__(self, seconds=None, attempts=None, tolerances=TOLERANCES, weights=CHECK_WEIGHTS, stop=None, metrics=None, on_best=None, on_mark=None, resume=None):
+        spent = {'seconds': 0.0, 'attempts': 0} if resume is None else resume
+        self.started = time.perf_counter() - spent['seconds']
+        self.deadline = None if seconds is None else self.started + seconds
+        self.attempts = attempts
+        self.stop = stop
+        self.on_best = on_best
+        self.on_mark = on_mark
+        self.resume = resume
+        self.next_mark = time.perf_counter() + CHECKPOINT_INTERVAL
+        self.metrics = metrics if metrics is not None or (attempts is None and on_mark is None) else SolverMetrics()
+        self.first_attempt = (0 if self.metrics is None else self.metrics.attempts) - spent['attempts']
+        weights = {**CHECK_WEIGHTS, **weights}
+        self.weights = np.array([weights[name] for name in list(tolerances) + CHECK_NAMES[-2:]])
+        self.best_labels = None
+        self.best_parts = None
+        self.best_score = np.inf
+
+    def is_set(self):
+        """Return true if the search should stop: the time or attempts are used up, or the outer stop event is set."""
+
+        if stopped(self.stop):
+            return True
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return True
+        return self.attempts is not None and self.metrics.attempts - self.first_attempt >= self.attempts
+
+    def score(self, parts):
+        """Return the weighted violation score of one or more divisions' violation_parts().  0 means every check passes."""
+
+        return parts @ self.weights
+
+    def offer(self, labels, parts):
+        """Keep a copy of the division if it scores better than the best one so far."""
+
+        score = float(self.score(parts))
+        if score < self.best_score:
+            self.best_score = score
+            self.best_labels = labels.copy()
+            self.best_parts = parts.copy()
+            if self.on_best is not None:
+                self.on_best(self.best_labels, self.best_parts)
+
+    def due(self):
+        """Return true if CHECKPOINT_INTERVAL seconds have passed since on_mark was last handed a point."""
+
+        return self.on_mark is not None and time.perf_counter() >= self.next_mark
+
+    def mark(self, rng_state, labels=None, step=0, grouped=False):
+        """Hand on_mark the point the search has reached, as a dictionary that can be written as JSON: the random generator's state and, inside an annealing run, the state that run drew its numbers from, then the run's current labels and step and whether it swaps within groups only.  The seconds and attempts spent so far are added."""
+
+        self.next_mark = time.perf_counter() + CHECKPOINT_INTERVAL
+        self.on_mark({'rng': rng_state, 'labels': None if labels is None else labels.copy(), 'step': int(step), 'grouped': grouped,
+                      'seconds': time.perf_counter() - self.started, 'attempts': 0 if self.metrics is None else self.metrics.attempts - self.first_attempt})
+
+class Checkpoint:
+    """A run's progress, kept in a small JSON file so an interrupted run can be resumed: the seed every random step is drawn from, each solved grade's class labels and violation_parts(), the best division seen so far and the point its search reached, from SearchBudget.mark(), in a grade still being searched, and the solver metrics' counts.  The file is saved whenever a grade is solved and every CHECKPOINT_INTERVAL seconds while one is searched; grades raced in parallel are only saved once decided.  fingerprint, from run_fingerprint(), ties the file to the students and settings it was saved for."""
+
+    def __init__(self, path, fingerprint, seed):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.seed = seed
+        self.grades = {}
+        self.best = {}
+        self.positions = {}
+        self.metrics = None
+        self.summary = None
+
+    @classmethod
+    def load(cls, path):
+        """Read a checkpoint saved by save()."""
+
+        with open(path) as f:
+            saved = json.load(f)
+        checkpoint = cls(path, saved['fingerprint'], saved['seed'])
+        checkpoint.grades = {grade: (np.array(division['labels'], dtype=np.int32), np.array(division['parts'])) for grade, division in saved['grades'].items()}
+        checkpoint.best = {grade: (np.array(division['labels'], dtype=np.int32), np.array(division['parts'])) for grade, division in saved['best'].items()}
+        checkpoint.positions = {grade: {**position, 'labels': None if position['labels'] is None else np.array(position['labels'], dtype=np.int32)} for grade, position in saved['positions'].items()}
+        checkpoint.summary = saved['metrics']
+        return checkpoint
+
+    def offer(self, grade, labels, parts):
+        """Keep a grade's best division so far, to be saved with the next point marked."""
+
+        self.best[grade] = (labels, parts)
+
+    def mark(self, grade, position):
+        """Keep the point a grade's search has reached and save."""
+
+        self.positions[grade] = position
+        self.save()
+
+    def finish(self, grade, labels, parts):
+        """Keep a solved grade's division and save."""
+
+        self.grades[grade] = (labels, parts)
+        self.best.pop(grade, None)
+        self.positions.pop(grade, None)
+        self.save()
+
+    def save(self):
+        """Write the checkpoint.  It is written to a temporary file first, so a crash while saving leaves the previous checkpoint whole."""
+
+        saved = {'fingerprint': self.fingerprint,
+                 'seed': self.seed,
+                 'grades': {grade: {'labels': labels.tolist(), 'parts': parts.tolist()} for grade, (labels, parts) in self.grades.items()},
+                 'best': {grade: {'labels': labels.tolist(), 'parts': parts.tolist()} for grade, (labels, parts) in self.best.items()},
+                 'positions': {grade: {**position, 'labels': None if position['labels'] is None else position['labels'].tolist()} for grade, position in self.positions.items()},
+                 'metrics': None if self.metrics is None else self.metrics.summary()}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(saved, f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+
+def check_misses(parts, tolerances=TOLERANCES):
+    """Turn one division's violation_parts() into a dictionary of the checks it misses and by how much: how far the spread is over the tolerance for a balance check, and how many students are out of place for a cluster check."""
+
+    # violation_parts() measures from the tolerance plus ROUNDING_ALLOWANCE, so add the allowance back to report the spread over the tolerance itself.
+    over = parts[:len(tolerances)]
+    amounts = np.append(np.where(over > 0, over * np.array(list(tolerances.values())) + ROUNDING_ALLOWANCE, 0), parts[len(tolerances):])
+    return {name: float(amount) for name, amount in zip(list(tolerances) + CHECK_NAMES[-2:], amounts) if amount > 0}
+
+def format_misses(misses):
+    """Return the checks each grade's classes miss as readable lines, one per check."""
+
+    return '\n'.join(f'{grade}: {name} missed by {amount:.3g}' + (' students' if name in CHECK_NAMES[-2:] else '') for grade, checks in misses.items() for name, amount in checks.items())
+
+def solve_grade_batched(encoded, n_classes, tolerances=TOLERANCES, stop=None, metrics=None, batch_size=BATCH_SIZE, rng=None):
+    """Score up to batch_size random divisions of one grade per NumPy call, as many as fit in BATCH_MEMORY, until one is within every tolerance and has acceptable clusters, and return its class labels.  Returns None if stopped first."""
+
+    rng = np.random.default_rng(rng)
+    n_students = len(encoded)
+    batch_size = int(max(1, min(batch_size, BATCH_MEMORY // (n_students * encoded.shape[1] * encoded.itemsize))))
+    marking = isinstance(stop, SearchBudget)
+    while not stopped(stop):
+        if marking and stop.due():
+            stop.mark(rng.bit_generator.state)
+        started = time.perf_counter()
+        orders = np.argsort(rng.random((batch_size, n_students)), axis=1)
+        shuffled = time.perf_counter()
+        stats = batch_stats(encoded, orders, n_classes)
+        counted = time.perf_counter()
+
+        # The cluster checks only run on candidates that already passed the cheaper tolerance checks.
+        balanced = tolerance_checks(stats, tolerances)
+        candidates = np.flatnonzero(np.all(balanced, axis=-1))
+        clusters_ok = batch_cluster_mask(stats[candidates])
+        affinity_ok = batch_affinity_mask(stats[candidates])
+        passing = candidates[clusters_ok & affinity_ok]
+
+        if metrics is not None:
+            failures = np.append((~balanced).sum(axis=0), [(~clusters_ok).sum(), (~affinity_ok).sum()])
+            checked = [batch_size] * len(tolerances) + [len(candidates)] * 2
+            metrics.add(batch_size, failures, checked, shuffled - started, counted - shuffled, time.perf_counter() - counted)
+        if len(passing):
+            return split_labels(orders[passing[0]], n_classes)
+
+        # On a budget, keep the batch's best candidate in case nothing passes in time.
+        if isinstance(stop, SearchBudget):
+            parts = violation_parts(stats, tolerances)
+            best = np.argmin(stop.score(parts))
+            stop.offer(split_labels(orders[best], n_classes), parts[best])
+
+    return None
+
+def load_cluster_rules(cluster_files=(CLUSTER_FILE,)):
+    """Read every sheet of the cluster files once and index each sheet's acceptable patterns by the number of classes it describes."""
+
+    for cluster_file in cluster_files:
+        sheets = pd.read_excel(cluster_file, header=None, sheet_name=None, dtype=str)
+        rules = {}
+        for sheet in sheets.values():
+            patterns = sheet.dropna().astype(float).astype(int)
+
+            # A sheet's width is the number of classes it applies to.  Patterns are stored sorted because class order does not matter.
+            rules[patterns.shape[1]] = {tuple(sorted(row)) for row in patterns.values.tolist()}
+        CLUSTER_RULES[cluster_file] = rules
+
+    CLUSTER_TABLES.clear()
+    return CLUSTER_RULES
+
+def cluster_patterns(cluster_file, nclasses):
+    """Return the set of acceptable patterns in the cluster file for a grade with this many classes.  The cluster files are only read the first time they are needed."""
+
+    if cluster_file not in CLUSTER_RULES:
+        load_cluster_rules()
+
+    return CLUSTER_RULES[cluster_file].get(int(nclasses), set())
+
+def pattern_table(cluster_file, nclasses):
+    """Return the acceptable patterns in the cluster file for a grade with this many classes as a 2-D integer array, one sorted pattern per row."""
+
+    key = (cluster_file, int(nclasses))
+    if key not in CLUSTER_TABLES:
+        CLUSTER_TABLES[key] = np.array(sorted(cluster_patterns(cluster_file, nclasses)), dtype=np.int64).reshape(-1, int(nclasses))
+    return CLUSTER_TABLES[key]
+
+def check_clusters(grade_to_check):
+    """Determine if the special education and gifted student of this grade fall into acceptable clusters defined by school.  Takes the per-class statistics matrix of the grade."""
 
     nclasses = len(grade_to_check)
-    check_good = True
-    school_clusters = pd.read_excel(CLUSTER_FILE_FLOAT, header=None, sheet_name=((nclasses)-2), dtype=str)
-    school_clusters = school_clusters.astype(float)
-    cluster_lists = school_clusters.values.tolist()
-    race_dict = {}
 
-    # If there's only one class, clusters are not applicable.
+    # If there's only one class, clusters are not applicable. 
     if nclasses == 1:
-        check_good = True
-        return check_good
-        pass 
-    else:
-        i = 0
-        for race in RACES:
-            race_list = sorted(grade_to_check[race].values.tolist())
-            race_list = [i[0] for i in race_list]
-            race_sum = sum(race_list)
-            #If there are 10 or more of one race we will not check for clusters. The rationale being that affinity at school is somewhat less important for large race groups. TODO This could lead to students without affinity (one student of a given race in a classroom with no race peers). This is not ideal no matter the student's race. Solving for a larger number of one race has led to extensive runtimes. 
-            if (race_sum > 9):
-                race_dict[i] = True
-            else:
-                if (sorted(race_list) in cluster_lists):
-                    race_dict[i] = True            
-                else:
-                    race_dict[i] = False
-            i = i +1
-
-    check_good = all(race_dict.values())
-    return check_good 
-
-def calculate_one_grade(grade):
-    """For every class in the one grade provided, calc averages and other data, and store them in a new dataframe and return the dataframe."""
-
-    """TODO This function is almost identical to the 'calculate' function, except that this code runs when the first classrooms set by 'calculate' do not meet acceptance tolerances. Restructure code in order to be more elegant and pythonic. Ran out of time."""
-
-    gender_list = []
-    iep_list = []
-    lap_list = []
-    sped_list = []
-    hcp_list = []
-    grade_list = []
-    att_list = []
-    irla_list = []
-    asian_list = []
-    black_list = []
-    hispanic_list =[]
-    multi_list = []
-    native_list = []
-    pi_list = []
-    white_list = []
-
-    racedf = pd.DataFrame(columns = RACES)
-
-    for c in grade:
-        iep_calc = c['504 - 2020-2021'].sum()/len(c)
-        iep_list.append(iep_calc)
-        att_calc = c['Attn % - 2020-2021'].sum()/len(c)
-        att_list.append(att_calc)
-        gender_calc = c['Gender'].sum()/len(c)
-        gender_list.append(gender_calc)
-        lap_calc = c['LAP Indicator - 2020-2021'].sum()/len(c)
-        lap_list.append(lap_calc)
-        sped_total = c['SPED'].sum()
-        sped_list.append(sped_total)
-        hcp_total = c['HCP - 2020-2021'].sum()
-        hcp_list.append(hcp_total)
-        irla_calc = c['IRLA-Score - 2020-2021'].sum()/len(c)
-        irla_list.append(irla_calc)
-        race_int= c['Race'].value_counts()
-        racedf = racedf.append(race_int, ignore_index=True)
-        racedf = racedf.fillna(0)
-        asian_list = racedf['Asian'].values.tolist()
-        black_list = racedf['Black'].to_list()
-        hispanic_list = racedf['Hispanic'].to_list()
-        multi_list = racedf['Multiple'].to_list()
-        native_list = racedf['Native'].to_list()
-        pi_list = racedf['Pacific Islander'].to_list()
-        white_list = racedf['White'].to_list()                      
-        g = c.iloc[0]['Grade']
-        grade_list.append(g)
-
-    new_calc_df = pd.DataFrame(columns=ALL_CATEGORIES,index=grade_list).rename_axis('Classes')
-    new_calc_df['Gender']= gender_list
-    new_calc_df['504 - 2020-2021'] = iep_list
-    new_calc_df['LAP Indicator - 2020-2021'] = lap_list
-    new_calc_df['SPED'] = sped_list
-    new_calc_df['HCP - 2020-2021'] = hcp_list
-    new_calc_df['Attn % - 2020-2021'] = att_list
-    new_calc_df['IRLA-Score - 2020-2021'] = irla_list
-    new_calc_df['Asian'] = asian_list
-    new_calc_df['Black'] = black_list
-    new_calc_df['Hispanic'] = hispanic_list
-    new_calc_df['Multiple'] = multi_list
-    new_calc_df['Native'] = native_list
-    new_calc_df['Pacific Islander'] = pi_list
-    new_calc_df['White'] = white_list
-
-    return new_calc_df
-
-def save_xlsx(list_dfs, xlsx_path):
-    """Write acceptable classes to Excel file."""
-
-    with ExcelWriter(xlsx_path) as writer:
-        i=0
-        for x in list_dfs:
-            for n, df in enumerate(x):
-                df.to_excel(writer,'sheet%s' % i)
-                i = i+1
-        writer.save()
-
-
-def main():
-    """This program accepts as input a file from a elementary school district's Student Identification System(SIS), randomly assigns student to classes for the next year, performs balance and cluster checking in accordance with user settings, then repeats until all balance and clustering are within tolerance. The program then writes next year's class lists to an Excel file for use by the school. For this prototype, a specific school collaborated with this project, and that school's district uses SIS software distributed by Synergy."""
+        return True
 
-    # Shuffle students within their grade levels.
-    shuffled_stu_by_grade = shuffle(students_by_grade)
-    
-    # Divide students into classes.
-    all_classes_by_grade = divide_into_classes(shuffled_stu_by_grade, cls_per_grade)
+    cluster_set = cluster_patterns(CLUSTER_FILE, nclasses)
+    sped = tuple(sorted(grade_to_check[:, STAT_INDEX['SPED']].astype(int).tolist()))
+    hcp = tuple(sorted(grade_to_check[:, STAT_INDEX['HCP - 2020-2021']].astype(int).tolist()))
 
-    # Fill in missing test scores with average for the class
-    cleaned_grades = missing_scores_school(all_classes_by_grade)
-    
-    # Create dataframes containing calculations for each class
-    calc_dfs = calculate(cleaned_grades)
-    
-    next_yrs_classes = []
-
-    i=0
-
-    # For each grade level, find the class that has the most and least of all binary categories.
-    for g in cleaned_grades:
-        print('Attempting to solve the outgoing', str(g[0].iloc[0]['Grade']), 'grade...')
-        gender_max = calc_dfs[i]['Gender'].max()
-        gender_min = calc_dfs[i]['Gender'].min()
-        iep_max = calc_dfs[i]['504 - 2020-2021'].max()
-        iep_min = calc_dfs[i]['504 - 2020-2021'].min()
-        lap_max = calc_dfs[i]['LAP Indicator - 2020-2021'].max()
-        lap_min = calc_dfs[i]['LAP Indicator - 2020-2021'].min()
-        att_max = calc_dfs[i]['Attn % - 2020-2021'].max()
-        att_min = calc_dfs[i]['Attn % - 2020-2021'].min()
-        irla_max = calc_dfs[i]['IRLA-Score - 2020-2021'].max()
-        irla_min = calc_dfs[i]['IRLA-Score - 2020-2021'].min()
-        
-        # Check special education and gifted clusters
-        cluster_check = check_clusters(calc_dfs[i])
+    return sped in cluster_set and hcp in cluster_set
         
-        # Check for appropriate race affinity clusters
-        affinity_diversity = affinity_diversity_check(calc_dfs[i])
- 
-        # If all tolerances and clusters are acceptable, save this class to the class list.
-        if((math.isclose(gender_max, gender_min, abs_tol = GENDER_TOL)) and (math.isclose(iep_max, iep_min, abs_tol = IEP_TOL)) and (math.isclose(lap_max, lap_min, abs_tol = LAP_TOL)) and (math.isclose(att_max, att_min, abs_tol = ATTENDANCE_TOL)) and (math.isclose(irla_max, irla_min, abs_tol = ATTENDANCE_TOL)) and cluster_check and affinity_diversity):
-            next_yrs_classes.append(g)
-
-        # If one tolerance is out of specification, or one category does not have acceptable clustering, repeat shuffling and checking. 
+def affinity_diversity_check(grade_to_check):
+    """Determine if every race group of this grade meets the affinity rule (AFFINITY_MIN and AFFINITY_SPREAD) and return true or false.  Takes the per-class statistics matrix of the grade."""
+
+    # Every race group is checked whatever its size, so no student is left as the only one of their race in a class.
+    return not affinity_distance(race_counts(grade_to_check)).any()
+
+def solve_grade_rejection(encoded, n_classes, tolerances=TOLERANCES, stop=None, metrics=None, rng=None):
+    """Randomly divide one grade into classes, one attempt at a time, until every tolerance and cluster check passes, and return the class labels.  Returns None if stopped first."""
+
+    rng = np.random.default_rng(rng)
+
+    # If one tolerance is out of specification, or one category does not have acceptable clustering, repeat shuffling and checking. 
+    marking = isinstance(stop, SearchBudget)
+    while not stopped(stop):
+        if marking and stop.due():
+            stop.mark(rng.bit_generator.state)
+        started = time.perf_counter()
+        labels = split_labels(rng.permutation(len(encoded)), n_classes)
+        shuffled = time.perf_counter()
+        stats = grade_stats(encoded, labels, n_classes)
+        counted = time.perf_counter()
+
+        # Check balance, then special education and gifted clusters, then race affinity groups.
+        passed = np.append(tolerance_checks(stats, tolerances), [check_clusters(stats), affinity_diversity_check(stats)])
+
+        if metrics is not None:
+            metrics.add(1, ~passed, 1, shuffled - started, counted - shuffled, time.perf_counter() - counted)
+        if passed.all():
+            return labels
+        if isinstance(stop, SearchBudget):
+            stop.offer(labels, violation_parts(stats, tolerances))
+
+    return None
+
+def anneal_grade(encoded, labels, n_classes, tolerances=TOLERANCES, steps=ANNEAL_STEPS, groups=None, stop=None, metrics=None, rng=None, first_step=0):
+    """Improve one grade's class labels by simulated annealing over single-student moves and two-student swaps.  Per-class sums are updated in place for each proposal instead of being recounted.  When groups are given, only students of the same group are swapped and nobody is moved alone.  Every accepted division is offered to stop if it is a SearchBudget, and the run's point is marked there when due.  A resumed run starts at first_step with the labels it had reached.  Returns the labels as soon as the violation score reaches 0, or None if the steps run out first."""
+
+    labels = labels.copy()
+    sums = class_sums(encoded, labels, n_classes)
+    sizes = np.bincount(labels, minlength=n_classes)
+    parts = violation_parts(stats_from_sums(sums), tolerances)
+    score = parts.sum()
+    keep = isinstance(stop, SearchBudget)
+    if keep:
+        stop.offer(labels, parts)
+
+    # Swaps within a group never change a cluster or race count, so only the starting division's clusters and affinity groups need measuring.
+    clusters = groups is None or parts[-2:].any()
+
+    # Draw every random number for the run up front.
+    started = time.perf_counter()
+    rng = np.random.default_rng(rng)
+    drawn_from = rng.bit_generator.state if keep else None
+    n_students = len(labels)
+    first = rng.integers(n_students, size=steps)
+    second = rng.integers(n_students, size=steps)
+    moves = rng.random(steps) < MOVE_SHARE
+    if groups is not None:
+        # Swap partners come from the first student's own group, so every group's count in every class stays the same.
+        members = np.argsort(groups, kind='stable')
+        group_starts = np.searchsorted(groups[members], groups)
+        group_sizes = np.bincount(groups)[groups]
+        second = members[group_starts[first] + (rng.random(steps) * group_sizes[first]).astype(int)]
+        moves[:] = False
+    accept = rng.random(steps)
+    temps = ANNEAL_START_TEMP * (ANNEAL_END_TEMP / ANNEAL_START_TEMP) ** (np.arange(steps) / steps)
+
+    # Metrics are handed the steps tried once per STOP_CHECK_INTERVAL steps rather than every step, which would slow the loop.  Each step's violation_parts() waits in trail until then, and the loop's time counts as stats time.
+    trail = np.zeros((STOP_CHECK_INTERVAL, len(parts)))
+    tried = 0
+    window = time.perf_counter()
+    if metrics is not None:
+        # The starting division counts as one attempt with its checks, unless a resumed run counted it already.
+        fresh = int(first_step == 0)
+        metrics.add(fresh, (parts > 0) * fresh, fresh, window - started)
+
+    def flush():
+        nonlocal tried, window
+        if metrics is not None and tried:
+            metrics.add(tried, (trail[:tried] > 0).sum(axis=0), tried, 0.0, time.perf_counter() - window)
+        tried = 0
+        window = time.perf_counter()
+
+    try:
+        for step in range(first_step, steps):
+            if score == 0:
+                return labels
+            if step % STOP_CHECK_INTERVAL == 0:
+                flush()
+                if keep and stop.due():
+                    stop.mark(drawn_from, labels, step, groups is not None)
+                if stopped(stop):
+                    return None
+
+            a, b = first[step], second[step]
+            p, q = labels[a], labels[b]
+            if p == q:
+                continue
+
+            # Moving student a to student b's class, or swapping the two, only changes the sums of classes p and q.
+            move = moves[step] and sizes[p] > sizes[q]
+            delta = -encoded[a] if move else encoded[b] - encoded[a]
+            sums[p] += delta
+            sums[q] -= delta
+            new_parts = violation_parts(stats_from_sums(sums), tolerances, clusters)
+            new_score = new_parts.sum()
+            trail[tried] = new_parts
+            tried += 1
+
+            if new_score <= score or accept[step] < np.exp((score - new_score) / temps[step]):
+                score = new_score
+                labels[a] = q
+                if move:
+                    sizes[p] -= 1
+                    sizes[q] += 1
+                else:
+                    labels[b] = p
+                if keep:
+                    stop.offer(labels, new_parts)
+            else:
+                sums[p] -= delta
+                sums[q] += delta
+    finally:
+        flush()
+
+    return labels if score == 0 else None
+
+def solve_grade_local_search(encoded, n_classes, tolerances=TOLERANCES, stop=None, metrics=None, steps=ANNEAL_STEPS, rng=None):
+    """Start from a random division of one grade and improve it by simulated annealing, restarting from a new division until every tolerance and cluster check passes, and return the class labels.  Returns None if stopped first."""
+
+    rng = np.random.default_rng(rng)
+    labels = None
+
+    # A resumed search first finishes the annealing run it was in.
+    resume = stop.resume if isinstance(stop, SearchBudget) else None
+    if resume is not None and resume['labels'] is not None:
+        labels = anneal_grade(encoded, resume['labels'], n_classes, tolerances, steps, stop=stop, metrics=metrics, rng=rng, first_step=resume['step'])
+    while labels is None and not stopped(stop):
+        start = split_labels(rng.permutation(len(encoded)), n_classes)
+        labels = anneal_grade(encoded, start, n_classes, tolerances, steps, stop=stop, metrics=metrics, rng=rng)
+
+    return labels
+
+def constrained_columns():
+    """Return the encoded columns whose per-class counts must match a pattern in the cluster file: special education and gifted."""
+
+    return [ENCODED_INDEX[category] for category in CLUSTERED_CATEGORIES]
+
+def repair_affinity(encoded, labels, n_classes, movable, rng=None):
+    """Swap movable students of two different races between two classes, each time the swap that brings the race groups closest to the affinity rule, until every race group meets it.  Between swaps that help equally, the one that evens out the two races' counts most is chosen, so a spread shared by several classes still comes down.  Changes labels in place and returns true if the rule is met, or false once no swap helps."""
+
+    rng = np.random.default_rng(rng)
+    races = encoded[:, ENCODED_INDEX[RACES[0]]:ENCODED_INDEX[RACES[0]] + len(RACES)]
+    in_class = np.eye(n_classes)[labels]
+    counts = races.T @ in_class
+    held = races[movable].T @ in_class[movable]
+
+    # shifts[source, target] takes one student out of the source class and puts one into the target class.
+    classes = np.eye(n_classes)
+    shifts = classes[None, :, :] - classes[:, None, :]
+
+    while True:
+        distance = affinity_distance(counts)
+        if not distance.any():
+            return True
+
+        # Move a student of the race furthest from the rule, swapping with a student of any other race who goes the other way.
+        race = np.argmax(distance)
+        change = (affinity_distance(counts[race] + shifts) - distance[race])[None] + affinity_distance(counts[:, None, None, :] - shifts) - distance[:, None, None]
+
+        # Moving one student from a class with c to a class with d changes the sum of squared counts by 2 * (d - c + 1).
+        evening = 2 * (counts[race][None, :] - counts[race][:, None] + 1)[None] + 2 * (counts[:, :, None] - counts[:, None, :] + 1)
+        change = change * 4 * len(labels) + evening
+        change[(held[race][:, None] == 0) | (held[:, None, :] == 0) | np.eye(n_classes, dtype=bool)] = np.inf
+        change[race] = np.inf
+        other, source, target = np.unravel_index(np.argmin(change), change.shape)
+        if change[other, source, target] >= 0:
+            return False
+
+        a = rng.choice(np.flatnonzero(movable & (labels == source) & (races[:, race] > 0)))
+        b = rng.choice(np.flatnonzero(movable & (labels == target) & (races[:, other] > 0)))
+        labels[a], labels[b] = target, source
+        for moved, shift in ((race, shifts[source, target]), (other, -shifts[source, target])):
+            counts[moved] += shift
+            held[moved] += shift
+
+def cluster_groups(encoded):
+    """Give every student a group number shared only with students who count toward exactly the same clustered categories and race, so swapping two students of one group never changes a cluster or race count."""
+
+    columns = constrained_columns() + [ENCODED_INDEX[race] for race in RACES]
+    _, groups = np.unique(encoded[:, columns] > 0, axis=0, return_inverse=True)
+    return groups.ravel()
+
+def construct_grade(encoded, n_classes, rng=None):
+    """Pick one acceptable pattern per clustered category and place those students into classes to match the patterns, then fill the remaining seats one race group at a time following the affinity rule, and repair what the greedy placement left outside it.  Returns the class labels, or None if the placement ran out of room or could not meet the affinity rule and should be tried again."""
+
+    rng = np.random.default_rng(rng)
+    n_students = len(encoded)
+    if n_classes == 1:
+        return np.zeros(n_students, dtype=np.int32)
+
+    # Pick a pattern for every constrained column whose total matches the grade's count, in a random class order.
+    columns = constrained_columns()
+    table = pattern_table(CLUSTER_FILE, n_classes)
+    remaining = np.empty((len(columns), n_classes), dtype=np.int64)
+    for row, column in enumerate(columns):
+        total = int(encoded[:, column].sum())
+        options = table[table.sum(axis=1) == total]
+        if len(options) == 0:
+            raise ValueError(f"{ENCODED_COLUMNS[column]}: no pattern in {CLUSTER_FILE} places {total} students into {n_classes} classes.")
+        remaining[row] = rng.permutation(options[rng.integers(len(options))])
+
+    member = encoded[:, columns] > 0
+    seats = class_sizes(n_students, n_classes)[rng.permutation(n_classes)]
+    labels = np.full(n_students, -1, dtype=np.int32)
+
+    # Students who count toward the most constrained columns go first, since they have the fewest classes to choose from.
+    placed = np.flatnonzero(member.any(axis=1))
+    placed = placed[np.lexsort((rng.random(len(placed)), -member[placed].sum(axis=1)))]
+    for student in placed:
+        needs = member[student]
+        fits = np.all(remaining[needs] > 0, axis=0) & (seats > 0)
+        if not fits.any():
+            return None
+
+        # Prefer the class with the most of this student's places still open.
+        room = np.where(fits, remaining[needs].sum(axis=0) + rng.random(n_classes), -1)
+        chosen = np.argmax(room)
+        labels[student] = chosen
+        remaining[needs, chosen] -= 1
+        seats[chosen] -= 1
+
+    # Everyone else fills the remaining seats one race group at a time, smallest group first, following the affinity rule.
+    races = (encoded[:, [ENCODED_INDEX[race] for race in RACES]] @ np.arange(1, len(RACES) + 1)).astype(int) - 1
+    for race in np.argsort(np.bincount(races[races >= 0], minlength=len(RACES)), kind='stable'):
+        counts = np.bincount(labels[(races == race) & (labels >= 0)], minlength=n_classes)
+        waiting = rng.permutation(np.flatnonzero((races == race) & (labels < 0)))
+        spread_out = counts.sum() + len(waiting) >= AFFINITY_MIN * n_classes
+        for left, student in zip(range(len(waiting), 0, -1), waiting):
+            open_seats = seats > 0
+            if not open_seats.any():
+                return None
+
+            # Finish any class that has too few of this race, then either keep every class within one of the fewest, or start a new class once there are enough students left for it.  Among the classes that fit, the one with the most open seats is chosen, which keeps the seats left for the largest race group even.
+            short = open_seats & (counts > 0) & (counts < AFFINITY_MIN)
+            if short.any():
+                fits = short
+            elif spread_out:
+                fits = open_seats & (counts <= counts[open_seats].min() + 1)
+            elif left >= AFFINITY_MIN and (open_seats & (counts == 0) & (seats >= AFFINITY_MIN)).any():
+                fits = open_seats & (counts == 0) & (seats >= AFFINITY_MIN)
+            else:
+                fits = open_seats & (counts > 0) if (open_seats & (counts > 0)).any() else open_seats
+                fits &= counts == counts[fits].min()
+
+            chosen = np.argmax(np.where(fits, seats + rng.random(n_classes), -1))
+            labels[student] = chosen
+            counts[chosen] += 1
+            seats[chosen] -= 1
+
+    # Students without a race fill whatever seats are left.
+    others = rng.permutation(np.flatnonzero(labels < 0))
+    labels[others] = np.repeat(np.arange(n_classes, dtype=np.int32), seats)
+
+    # Only students outside every cluster are swapped to repair the race groups, so the cluster patterns still hold.
+    if not repair_affinity(encoded, labels, n_classes, ~member.any(axis=1), rng):
+        return None
+    return labels
+
+def solve_grade_cluster_first(encoded, n_classes, tolerances=TOLERANCES, stop=None, metrics=None, steps=ANNEAL_STEPS, rng=None):
+    """Build a division of one grade whose clusters and race affinity groups pass by construction, then balance it by annealing over swaps that keep every cluster and race count, restarting until every tolerance passes, and return the class labels.  Returns None if stopped first."""
+
+    rng = np.random.default_rng(rng)
+    groups = cluster_groups(encoded)
+    labels = None
+
+    # A resumed search first finishes the annealing run it was in.
+    resume = stop.resume if isinstance(stop, SearchBudget) else None
+    if resume is not None and resume['labels'] is not None:
+        labels = anneal_grade(encoded, resume['labels'], n_classes, tolerances, steps, groups if resume['grouped'] else None, stop, metrics, rng, resume['step'])
+    while labels is None and not stopped(stop):
+        started = time.perf_counter()
+        start = None
+        for attempt in range(PLACEMENT_ATTEMPTS):
+            start = construct_grade(encoded, n_classes, rng)
+            if start is not None:
+                break
+        if metrics is not None:
+            metrics.add(0, 0, 0, time.perf_counter() - started)
+
+        if start is None:
+            start = split_labels(rng.permutation(len(encoded)), n_classes)
+            labels = anneal_grade(encoded, start, n_classes, tolerances, steps, stop=stop, metrics=metrics, rng=rng)
         else:
-            while ((math.isclose(gender_max, gender_min, abs_tol = GENDER_TOL)) and (math.isclose(iep_max, iep_min, abs_tol = IEP_TOL)) and (math.isclose(lap_max, lap_min, abs_tol = LAP_TOL)) and (math.isclose(att_max, att_min, abs_tol = ATTENDANCE_TOL)) and  (math.isclose(irla_max, irla_min, abs_tol = ATTENDANCE_TOL)) and cluster_check and affinity_diversity) == False:
-
-                r = reshuffle_one_grade(shuffled_stu_by_grade[i])
-                new_classes = divide_one_grade(r, cls_per_grade[i])
-                cleaned_grade = missing_scores_gradelevel(new_classes)
-                new_calc_df = calculate_one_grade(cleaned_grade)
-                
-                print('Attempting to solve the outgoing', str(g[0].iloc[0]['Grade']), 'grade for next year...')
-                print('Gender balance within tolerance?                                             ', str(math.isclose(gender_max, gender_min, abs_tol = GENDER_TOL)), '                    ', str(g[0].iloc[0]['Grade']))
-                print('IEP student balance within tolerance?                                        ', str(math.isclose(iep_max, iep_min, abs_tol = IEP_TOL)), '                    ', str(g[0].iloc[0]['Grade']))
-                print('Students with LAP indicator balance within tolerance?                        ', str(math.isclose(lap_max, lap_min, abs_tol = LAP_TOL)), '                    ', str(g[0].iloc[0]['Grade']))
-                print('Historical attendance balance within tolerance?                              ', str(math.isclose(att_max, att_min, abs_tol = ATTENDANCE_TOL)), '                    ', str(g[0].iloc[0]['Grade']))
-                print('Each class balanced for IRLA scores?                                         ', str(math.isclose(irla_max, irla_min, abs_tol = ATTENDANCE_TOL)), '                    ', str(g[0].iloc[0]['Grade']))
-                print('Each class checked for acceptable special education and HiCap clusters?      ', str(cluster_check), '                    ', str(g[0].iloc[0]['Grade']))
-                print('Race affinity and diversity checks complete?                                 ', str(affinity_diversity), '                    ', str(g[0].iloc[0]['Grade']))
-
-                gender_max = new_calc_df['Gender'].max()
-                gender_min = new_calc_df['Gender'].min()
-                iep_max = new_calc_df['504 - 2020-2021'].max()
-                iep_min = new_calc_df['504 - 2020-2021'].min()
-                lap_max = new_calc_df['LAP Indicator - 2020-2021'].max()
-                lap_min = new_calc_df['LAP Indicator - 2020-2021'].min()
-                att_max = new_calc_df['Attn % - 2020-2021'].max()
-                att_min = new_calc_df['Attn % - 2020-2021'].min()
-                irla_max = new_calc_df['IRLA-Score - 2020-2021'].max()
-                irla_min = new_calc_df['IRLA-Score - 2020-2021'].min()
-                cluster_check = check_clusters(new_calc_df)
-                affinity_diversity = affinity_diversity_check(new_calc_df)
-
-            """TODO unclean final classes by unfilling missing test scores so school will have correct data (missing test scores) in their new class lists"""
-
-            next_yrs_classes.append(new_classes)
-        i = i+1 
-    
+            labels = anneal_grade(encoded, start, n_classes, tolerances, steps, groups, stop, metrics, rng)
+
+    return labels
+
+def min_spread(total, most, sizes):
+    """Return the smallest spread of class averages any division can reach for a category whose per-student values are whole numbers from 0 to most, summing to total, given the class sizes.  Which students hold the values is ignored, so this is a lower bound on the real spread."""
+
+    sizes = np.asarray(sizes)
+    if len(sizes) == 1:
+        return 0.0
+
+    # Every class average is a whole-number sum over the class size, so the narrowest window holding all of them starts and ends on such a fraction.
+    fractions = np.unique(np.concatenate([np.arange(most * size + 1) / size for size in np.unique(sizes)]))
+    least = np.ceil(fractions[:, None] * sizes - ROUNDING_ALLOWANCE).sum(axis=1)
+    largest = np.floor(fractions[:, None] * sizes + ROUNDING_ALLOWANCE).sum(axis=1)
+
+    # A window [low, high] works if the class sums it allows can add up to the total.
+    widths = fractions[None, :] - fractions[:, None]
+    fits = (widths >= 0) & (least[:, None] <= total) & (largest[None, :] >= total)
+    return float(widths[fits].min())
+
+def affinity_possible(total, n_classes):
+    """Return true if a race group of total students can be divided over n_classes classes so that it meets the affinity rule."""
+
+    if total < AFFINITY_MIN or n_classes == 1:
+        return True
+
+    # With enough students every class gets some, and an even split differs by at most one.
+    if total >= AFFINITY_MIN * n_classes:
+        return AFFINITY_SPREAD >= 1 or total % n_classes == 0
+
+    # Otherwise some class has none, so every class that has some needs between AFFINITY_MIN and AFFINITY_SPREAD.
+    return any(used * AFFINITY_MIN <= total <= used * AFFINITY_SPREAD for used in range(1, n_classes))
+
+class InfeasibleError(ValueError):
+    """Raised when the feasibility check finds grades that no division into classes can pass."""
+
+def analyze_feasibility(encoded, n_classes, tolerances=TOLERANCES):
+    """Check one encoded grade against the cluster patterns and tolerance bounds before any search starts, and return a list of reasons no division of it can pass.  An empty list means no problem was found, not that a division is sure to exist."""
+
+    n_students = len(encoded)
+    if n_classes < 1 or n_classes > n_students:
+        return [f'{n_classes} classes cannot be formed from {n_students} students.']
+
+    problems = []
+
+    # Every clustered category's total needs a pattern for this many classes in the indexed cluster file.
+    if n_classes > 1:
+        if not cluster_patterns(CLUSTER_FILE, n_classes):
+            problems.append(f'{CLUSTER_FILE} has no sheet for {n_classes} classes.')
+        table = pattern_table(CLUSTER_FILE, n_classes)
+        for column in constrained_columns():
+            total = int(encoded[:, column].sum())
+            if len(table) and not (table.sum(axis=1) == total).any():
+                problems.append(f'{ENCODED_COLUMNS[column]}: no pattern in {CLUSTER_FILE} places {total} students into {n_classes} classes.')
+
+    # Every race group has to be divisible under the affinity rule.
+    for race in RACES:
+        total = int(encoded[:, ENCODED_INDEX[race]].sum())
+        if not affinity_possible(total, n_classes):
+            problems.append(f'{race}: {total} students cannot be divided into {n_classes} classes with at least {AFFINITY_MIN} in every class that has any and counts within {AFFINITY_SPREAD} of each other.')
+
+    # Even the best split of each averaged category over these class sizes has to fit within its tolerance.
+    sizes = class_sizes(n_students, n_classes)
+    for category, most in CATEGORY_MAXIMUMS.items():
+        if category in tolerances:
+            spread = min_spread(int(round(encoded[:, ENCODED_INDEX[category]].sum())), most, sizes)
+            if spread > tolerances[category] + ROUNDING_ALLOWANCE:
+                problems.append(f'{category}: the closest balance possible with classes of {sizes.min()}-{sizes.max()} students is a spread of {spread:.3f}, over the tolerance of {tolerances[category]}.')
+
+    return problems
+
+def feasibility_report(students_df, classes_per_grade, tolerances=TOLERANCES):
+    """Run analyze_feasibility() on every grade of a converted student body that has a class count, and return a dictionary of the problems found in each grade that has any."""
+
+    if not isinstance(classes_per_grade, dict):
+        classes_per_grade = dict(zip(EXIT_GRADES, classes_per_grade))
+
+    store = build_student_store(students_df)
+    report = {}
+    for code, grade in enumerate(EXIT_GRADES):
+        members = store[store['Grade'] == code]
+        if grade in classes_per_grade and len(members):
+            problems = analyze_feasibility(encode_grade(members), int(classes_per_grade[grade]), tolerances)
+            if problems:
+                report[grade] = problems
+    return report
+
+def format_feasibility_report(report):
+    """Return a feasibility report as readable lines, one per problem, each starting with its exit grade."""
+
+    return '\n'.join(f'{grade}: {problem}' for grade, problems in report.items() for problem in problems)
+
+# Solvers main() can use, selected by SOLVER_MODE.  Each takes an encoded grade, a number of classes, the tolerances, an optional stop event, optional SolverMetrics and an optional NumPy random generator every random step draws from, and returns a class label per student.
+SOLVERS = {'rejection': solve_grade_rejection, 'batch': solve_grade_batched, 'local': solve_grade_local_search, 'cluster': solve_grade_cluster_first}
+
+def solve_grade_anytime(encoded, n_classes, solver_mode=SOLVER_MODE, tolerances=TOLERANCES, seconds=None, attempts=None, weights=CHECK_WEIGHTS, stop=None, metrics=None, rng=None, on_best=None, best=None, on_mark=None, resume=None):
+    """Run one solver on one grade until it finds a division that passes every check or its budget of seconds or attempts runs out, and return the division it found, or else the best one it saw, with its violation_parts().  Without a budget this runs until the grade is solved.  rng is the random generator, or seed, the search draws from.  on_best is called with every better division found, and best, a (labels, parts) pair such as a Checkpoint keeps, is the best division to beat from the start.  on_mark is called every CHECKPOINT_INTERVAL seconds with the point the search has reached, and resume, one such point, continues the search from there.  Returns (None, None) if the outer stop event is set first."""
+
+    rng = np.random.default_rng(rng)
+    if seconds is None and attempts is None and on_best is None and on_mark is None:
+        labels = SOLVERS[solver_mode](encoded, n_classes, tolerances, stop=stop, metrics=metrics, rng=rng)
+        if labels is None:
+            return None, None
+        return labels, np.zeros(len(tolerances) + 2)
+
+    budget = SearchBudget(seconds, attempts, tolerances, weights, stop, metrics, on_best, on_mark, resume)
+    if best is not None:
+        budget.offer(*best)
+    if resume is not None:
+        rng.bit_generator.state = resume['rng']
+    labels = SOLVERS[solver_mode](encoded, n_classes, tolerances, stop=budget, metrics=budget.metrics, rng=rng)
+    if stopped(stop):
+        return None, None
+    if labels is None:
+        labels = budget.best_labels
+    if labels is None:
+        # The budget ran out before the solver looked at a single division.
+        labels = split_labels(rng.permutation(len(encoded)), n_classes)
+    return labels, violation_parts(grade_stats(encoded, labels, n_classes), tolerances)
+
+def solve_grade_seeded(encoded, n_classes, solver_mode, tolerances, seed, stop, seconds=None, attempts=None, weights=CHECK_WEIGHTS):
+    """Worker entry point: run one solver on one grade within the budget, drawing every random number from a generator seeded with seed, and return the class labels and their violation_parts(), or None twice if another worker solved the grade first, together with the run's metrics summary."""
+
+    metrics = SolverMetrics()
+    labels, parts = solve_grade_anytime(encoded, n_classes, solver_mode, tolerances, seconds, attempts, weights, stop, metrics, np.random.default_rng(seed))
+    return labels, parts, metrics.summary()
+
+def solve_grades_parallel(encoded_grades, n_classes_per_grade, solver_mode=SOLVER_MODE, tolerances=TOLERANCES, workers=PARALLEL_WORKERS, seeds=RACING_SEEDS, metrics=None, seconds=None, attempts=None, weights=CHECK_WEIGHTS, on_grade=None, rngs=None):
+    """Solve every grade in a process pool, racing independently seeded solver runs for each grade, their seeds drawn from the grade's generator in rngs if given.  The lowest-numbered valid run for a grade wins once every run before it has finished, and the other runs for it are cancelled; on a budget, the run with the best weighted score wins if none is valid, so a seeded race always picks the same winner.  Every finished run's counts are merged into metrics if given, and on_grade, if given, is called with each grade's position, class labels and violation_parts() as soon as that grade is decided.  Returns the class labels and their violation_parts() in grade order."""
+
+    results = [None] * len(encoded_grades)
+    results_parts = [None] * len(encoded_grades)
+    ranking = SearchBudget(tolerances=tolerances, weights=weights)
+    with Manager() as manager, ProcessPoolExecutor(max_workers=workers or None) as pool:
+        stops = [manager.Event() for _ in encoded_grades]
+        futures = {}
+        for grade, (encoded, n_classes) in enumerate(zip(encoded_grades, n_classes_per_grade)):
+            for racer, seed in enumerate(np.random.default_rng(None if rngs is None else rngs[grade]).integers(2**31, size=seeds)):
+                futures[pool.submit(solve_grade_seeded, encoded, int(n_classes), solver_mode, tolerances, seed, stops[grade], seconds, attempts, weights)] = grade, racer
+        # Each racer's labels and violation_parts() once it is in, so the winner never depends on which racer finished first.
+        finished = [[None] * seeds for _ in encoded_grades]
+
+        try:
+            for future in as_completed(futures):
+                grade, racer = futures[future]
+                if future.cancelled():
+                    continue
+                labels, parts, summary = future.result()
+                if metrics is not None:
+                    metrics.merge(summary)
+                if stops[grade].is_set():
+                    continue
+                finished[grade][racer] = (labels, parts)
+
+                # The lowest-numbered valid racer wins once every racer before it is in; with no valid racer,
+                # the best weighted score wins once all are in, ties going to the lower-numbered racer.
+                winner = None
+                for outcome in finished[grade]:
+                    if outcome is None:
+                        break
+                    if outcome[0] is not None and not outcome[1].any():
+                        winner = outcome
+                        break
+                else:
+                    for outcome in finished[grade]:
+                        if outcome[0] is not None and (winner is None or ranking.score(outcome[1]) < ranking.score(winner[1])):
+                            winner = outcome
+                if winner is None:
+                    continue
+                results[grade], results_parts[grade] = winner
+
+                # Stop the runs still working on this grade and drop the ones that have not started.
+                stops[grade].set()
+                for other, (other_grade, _) in futures.items():
+                    if other_grade == grade:
+                        other.cancel()
+                if on_grade is not None:
+                    on_grade(grade, *winner)
+        except BaseException:
+            # Let every worker finish quickly so the pool can shut down before the error is raised.
+            for stop in stops:
+                stop.set()
+            raise
+
+    return results, results_parts
+
+def fresh_seed():
+    """Return a new seed drawn from the operating system, small enough to type back in with --seed."""
+
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+def run_fingerprint(encoded_grades, n_classes_per_grade, grades, config):
+    """Return a hash of everything besides the seed that decides a run's divisions: every grade's encoded students and number of classes, the solver, the tolerances, the budgets and whether grades are raced in parallel.  A checkpoint only resumes a run with the same fingerprint."""
+
+    digest = hashlib.sha256()
+    for grade, encoded, n_classes in zip(grades, encoded_grades, n_classes_per_grade):
+        digest.update(f'{grade}:{n_classes}:'.encode())
+        digest.update(np.ascontiguousarray(encoded).tobytes())
+    settings = [config['solver'], config['tolerances'], config['time_budget'], config['attempt_budget'], config['weights'], bool(config['workers']), config['seeds']]
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def full_config(config=None):
+    """Return config with everything it leaves out taken from DEFAULT_CONFIG, and its tolerances merged into TOLERANCES."""
+
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    config['tolerances'] = {**TOLERANCES, **(config['tolerances'] or {})}
+    return config
+
+def solve_school(students_df, classes_per_grade, config=None):
+    """Divide every grade of a converted student body into classes and return each student's class number (0 for the first class of a grade) as a Series indexed like students_df, with the checks each grade's division misses in attrs['misses'] and the seed it was drawn from in attrs['seed'].  classes_per_grade maps exit grade to number of classes, or lists them in EXIT_GRADES order; config overrides any of DEFAULT_CONFIG."""
+
+    config = full_config(config)
+    if not isinstance(classes_per_grade, dict):
+        classes_per_grade = dict(zip(EXIT_GRADES, classes_per_grade))
+
+    # The solver only sees the compact student store and one int32 class-assignment vector over it.
+    store = build_student_store(students_df)
+    assignment = np.full(len(store), -1, dtype=np.int32)
+    grade_members = [np.flatnonzero(store['Grade'] == code) for code in range(len(EXIT_GRADES))]
+    grades = [code for code, grade in enumerate(EXIT_GRADES) if grade in classes_per_grade and len(grade_members[code])]
+
+    # Encode every grade once.  Every attempt after this only works on class-label vectors.
+    encoded_grades = [encode_grade(store[grade_members[code]]) for code in grades]
+    n_classes_per_grade = [int(classes_per_grade[EXIT_GRADES[code]]) for code in grades]
+
+    # Refuse grades that cannot be solved before any search starts.
+    if config['check_feasibility']:
+        report = {EXIT_GRADES[code]: analyze_feasibility(encoded, n_classes, config['tolerances']) for code, encoded, n_classes in zip(grades, encoded_grades, n_classes_per_grade)}
+        report = {grade: problems for grade, problems in report.items() if problems}
+        if report:
+            raise InfeasibleError('Some grades cannot be divided into classes that pass every check:\n' + format_feasibility_report(report))
+
+    # One seed drives every random step.  Each exit grade draws from its own stream spawned from it, so a grade's division does not depend on which other grades are solved or in what order.
+    metrics = config['metrics']
+    seed = config['seed']
+    checkpoint = None
+    if config['checkpoint'] is not None:
+        metrics = SolverMetrics() if metrics is None else metrics
+        fingerprint = run_fingerprint(encoded_grades, n_classes_per_grade, [EXIT_GRADES[code] for code in grades], config)
+        if config['resume'] and os.path.exists(config['checkpoint']):
+            checkpoint = Checkpoint.load(config['checkpoint'])
+            if checkpoint.fingerprint != fingerprint:
+                raise ValueError(f"{config['checkpoint']} was saved for other students, class counts or settings and cannot be resumed.")
+            if seed is not None and seed != checkpoint.seed:
+                raise ValueError(f"{config['checkpoint']} was saved with seed {checkpoint.seed}, not {seed}.")
+            seed = checkpoint.seed
+            if checkpoint.summary is not None:
+                metrics.merge(checkpoint.summary)
+        else:
+            seed = fresh_seed() if seed is None else seed
+            checkpoint = Checkpoint(config['checkpoint'], fingerprint, seed)
+        checkpoint.metrics = metrics
+    if seed is None:
+        seed = fresh_seed()
+    streams = np.random.SeedSequence(seed).spawn(len(EXIT_GRADES))
+
+    # Hand each grade to the checkpoint and to on_grade as soon as it is solved, so its classes can be written before the next grade finishes.
+    def finished(position, labels, parts):
+        if checkpoint is not None:
+            checkpoint.finish(EXIT_GRADES[grades[position]], labels, parts)
+        if config['on_grade'] is not None:
+            members = grade_members[grades[position]]
+            stats = grade_stats(encoded_grades[position], labels, n_classes_per_grade[position])
+            config['on_grade'](EXIT_GRADES[grades[position]], pd.Series(labels, index=students_df.index[store['row'][members]], name='Class'), stats)
+
+    # Grades a resumed checkpoint already holds are not solved again.
+    all_labels, all_parts = [None] * len(grades), [None] * len(grades)
+    todo = []
+    for position, code in enumerate(grades):
+        if checkpoint is not None and EXIT_GRADES[code] in checkpoint.grades:
+            all_labels[position], all_parts[position] = checkpoint.grades[EXIT_GRADES[code]]
+            finished(position, all_labels[position], all_parts[position])
+        else:
+            todo.append(position)
+
+    budget = {'seconds': config['time_budget'], 'attempts': config['attempt_budget'], 'weights': config['weights']}
+    if config['workers']:
+        if metrics is not None:
+            metrics.begin('all grades')
+        rngs = [np.random.default_rng(streams[grades[position]]) for position in todo]
+        on_grade = lambda index, labels, parts: finished(todo[index], labels, parts)
+        solved_labels, solved_parts = solve_grades_parallel([encoded_grades[position] for position in todo], [n_classes_per_grade[position] for position in todo], config['solver'], config['tolerances'],
+                                                            config['workers'], config['seeds'], metrics, on_grade=on_grade, rngs=rngs, **budget)
+        for position, labels, parts in zip(todo, solved_labels, solved_parts):
+            all_labels[position], all_parts[position] = labels, parts
+        if metrics is not None:
+            metrics.report()
+    else:
+        for position in todo:
+            grade = EXIT_GRADES[grades[position]]
+            if metrics is not None:
+                metrics.begin(grade)
+            # A grade the checkpoint was still searching picks up where its search stopped.
+            resume = best = on_best = on_mark = None
+            if checkpoint is not None:
+                resume, best = checkpoint.positions.get(grade), checkpoint.best.get(grade)
+                on_best = lambda labels, parts: checkpoint.offer(grade, labels, parts)
+                on_mark = lambda position: checkpoint.mark(grade, position)
+            labels, parts = solve_grade_anytime(encoded_grades[position], n_classes_per_grade[position], config['solver'], config['tolerances'], metrics=metrics,
+                                                rng=np.random.default_rng(streams[grades[position]]), on_best=on_best, best=best, on_mark=on_mark, resume=resume, **budget)
+            all_labels[position] = labels
+            all_parts[position] = parts
+            if metrics is not None:
+                metrics.report()
+            finished(position, labels, parts)
+
+    for code, labels in zip(grades, all_labels):
+        assignment[grade_members[code]] = labels
+
+    # Map back to the dataframe's rows only for the result.
+    solved = store['row'][assignment >= 0]
+    assignments = pd.Series(assignment[assignment >= 0], index=students_df.index[solved], name='Class')
+    misses = {EXIT_GRADES[code]: check_misses(parts, config['tolerances']) for code, parts in zip(grades, all_parts)}
+    assignments.attrs['misses'] = {grade: checks for grade, checks in misses.items() if checks}
+    assignments.attrs['seed'] = seed
+    return assignments
+
+def changed_scores(sums, stats, classes, deltas, tolerances=TOLERANCES):
+    """Score candidate changes to one grade's division, each adding a row of deltas to the sums of class classes[k, 0] and taking it from class classes[k, 1].  Only those two classes are recounted; every other class keeps its statistics.  Returns the violation score of every candidate."""
+
+    rows = np.arange(len(classes))
+    candidates = np.repeat(stats[None], len(classes), axis=0)
+    candidates[rows, classes[:, 0]] = stats_from_sums(sums[classes[:, 0]] + deltas)
+    candidates[rows, classes[:, 1]] = stats_from_sums(sums[classes[:, 1]] - deltas)
+    return violation_score(candidates, tolerances)
+
+def repair_grade(encoded, labels, n_classes, tolerances=TOLERANCES):
+    """Bring one grade's existing division back within every check after its enrollment changed, moving as few of its students as possible, and return the new class labels.  Students labelled -1 are new and are first placed, one at a time, in whichever of the smallest classes suits them best.  Then each round makes the one move or two-student swap that lowers the violation score most per student moved, until every check passes or no change helps."""
+
+    labels = labels.copy()
+    placed = labels >= 0
+    sums = class_sums(encoded[placed], labels[placed], n_classes)
+
+    for student in np.flatnonzero(~placed):
+        sizes = np.bincount(labels[labels >= 0], minlength=n_classes)
+        smallest = np.flatnonzero(sizes == sizes.min())
+        candidates = np.repeat(sums[None], len(smallest), axis=0)
+        candidates[np.arange(len(smallest)), smallest] += encoded[student]
+        chosen = smallest[np.argmin(violation_score(stats_from_sums(candidates), tolerances))]
+        labels[student] = chosen
+        sums[chosen] += encoded[student]
+
+    score = violation_score(stats_from_sums(sums), tolerances)
+    while score > 0:
+        stats = stats_from_sums(sums)
+        sizes = np.bincount(labels, minlength=n_classes)
+
+        # Every student moved to every other class.  Only moves into a class with fewer students are made, so class sizes never drift apart.
+        students, targets = np.nonzero(np.arange(n_classes)[None, :] != labels[:, None])
+        move_scores = changed_scores(sums, stats, np.stack([targets, labels[students]], axis=1), encoded[students], tolerances)
+        move_gains = np.where(sizes[targets] < sizes[labels[students]], score - move_scores, -np.inf)
+
+        # The students whose moves would help most are also tried in swaps with every student in another class.
+        leads = pd.unique(students[np.argsort(move_scores, kind='stable')])[:REPAIR_SWAP_CANDIDATES]
+        firsts, seconds = np.nonzero(labels[leads][:, None] != labels[None, :])
+        firsts = leads[firsts]
+        swap_scores = changed_scores(sums, stats, np.stack([labels[seconds], labels[firsts]], axis=1), encoded[firsts] - encoded[seconds], tolerances)
+        swap_gains = (score - swap_scores) / 2
+
+        # Make the change that helps most per student it moves, or stop if none helps.
+        best_move, best_swap = np.argmax(move_gains), np.argmax(swap_gains)
+        if max(move_gains[best_move], swap_gains[best_swap]) <= 0:
+            break
+        if move_gains[best_move] >= swap_gains[best_swap]:
+            student, target = students[best_move], targets[best_move]
+            sums[labels[student]] -= encoded[student]
+            sums[target] += encoded[student]
+            labels[student] = target
+            score = move_scores[best_move]
+        else:
+            a, b = firsts[best_swap], seconds[best_swap]
+            delta = encoded[a] - encoded[b]
+            sums[labels[a]] -= delta
+            sums[labels[b]] += delta
+            labels[a], labels[b] = labels[b], labels[a]
+            score = swap_scores[best_swap]
+
+    return labels
+
+def roster_delta(previous_students, students_df):
+    """Compare the student body a saved division was formed from with the current one and return a dictionary of the exit-grade student IDs 'added', 'removed', and 'changed' in their grade or any category the solver uses."""
+
+    # Only exit grades are divided into classes, so students in other grades are not part of either division.
+    students_df = students_df[students_df['Grade'].isin(EXIT_GRADES)]
+    previous_students = previous_students[previous_students['Grade'].isin(EXIT_GRADES)]
+    kept = students_df.index.intersection(previous_students.index)
+    before = build_student_store(previous_students.loc[kept])
+    after = build_student_store(students_df.loc[kept])
+    changed = np.zeros(len(kept), dtype=bool)
+    for field in STUDENT_DTYPE.names[1:]:
+        changed |= ~np.isclose(before[field], after[field], equal_nan=True)
+
+    return {'added': students_df.index.difference(previous_students.index),
+            'removed': previous_students.index.difference(students_df.index),
+            'changed': kept[changed]}
+
+def repair_school(students_df, previous_students, previous, tolerances=TOLERANCES):
+    """Update a saved division for enrollment changes instead of solving again.  previous_students and previous are what load_assignments() returns.  Students who left are dropped and every grade with an added, removed or changed student is repaired by repair_grade(), keeping its number of classes; students who changed grade count as new in their new grade.  Grades without a change keep their classes and are not checked again.  Returns each student's class number like solve_school(), with attrs['delta'] from roster_delta(), attrs['moved'] holding the IDs of the students in each repaired grade who changed class, and attrs['misses'] any checks a repaired grade still misses."""
+
+    delta = roster_delta(previous_students, students_df)
+    store = build_student_store(students_df)
+    assignment = previous.reindex(students_df.index).fillna(-1).to_numpy(dtype=np.int32)
+
+    # Students who changed grade start over in their new grade.
+    old_grades = previous_students['Grade'].reindex(students_df.index)
+    assignment[(old_grades.notna() & (old_grades != students_df['Grade'])).to_numpy()] = -1
+
+    touched = delta['added'].union(delta['removed']).union(delta['changed'])
+    affected = set(students_df['Grade'].reindex(touched).dropna()) | set(previous_students['Grade'].reindex(touched).dropna())
+
+    moved, misses = {}, {}
+    for code, grade in enumerate(EXIT_GRADES):
+        members = np.flatnonzero(store['Grade'] == code)
+        if grade not in affected or not len(members):
+            continue
+        saved = previous[(previous_students['Grade'] == grade).to_numpy()]
+        if saved.empty:
+            raise ValueError(f'{grade}: the saved classes have no students in this grade to repair.')
+
+        encoded = encode_grade(store[members])
+        n_classes = int(saved.max()) + 1
+        labels = assignment[members]
+        repaired = repair_grade(encoded, labels, n_classes, tolerances)
+        moved[grade] = students_df.index[store['row'][members][(labels >= 0) & (repaired != labels)]]
+        assignment[members] = repaired
+
+        grade_misses = check_misses(violation_parts(grade_stats(encoded, repaired, n_classes), tolerances), tolerances)
+        if grade_misses:
+            misses[grade] = grade_misses
+
+    solved = (assignment >= 0) & (store['Grade'] >= 0)
+    assignments = pd.Series(assignment[solved], index=students_df.index[solved], name='Class')
+    assignments.attrs.update({'delta': delta, 'moved': moved, 'misses': misses})
+    return assignments
+
+def success_message(tolerances=TOLERANCES):
+    """Return the message telling the school which tolerances every grade's classes were formed with."""
+
     s = ("Congratulations! Your classes have been formed with the following tolerances: \n"
-            "Every class within each grade level has within " + (str(GENDER_TOL*100)) + "% the same number of boys.\n"
-            "Every class within each grade level has within " + (str(IEP_TOL*100)) + "% the same number of students who have an IEP. \n"
-            "Every class within each grade level has within " + (str(LAP_TOL*100)) + "% the same number of students who have a Learning Acquisition Plan indicator. \n"
-            "After grouping attendance into three categories (Above 90%, 90-80%, and below 80%), every class within each grade level has a distribution of students in these categories within " + (str(ATTENDANCE_TOL*100)) + "%. \n"
-            "Every class within each grade level has balanced achievement. The average of students' standardized test scores for each class is within " + (str(IRLA_TOL*100)) + "%. \n"
-            "All special education and highly capable students are clustered in accordance with your cluster file, and students' races are balanced across classrooms with special affinity groups assigned in accordance with your cluster file. \n")
+            "Every class within each grade level has within " + (str(tolerances['Gender']*100)) + "% the same number of boys.\n"
+            "Every class within each grade level has within " + (str(tolerances['504 - 2020-2021']*100)) + "% the same number of students who have an IEP. \n"
+            "Every class within each grade level has within " + (str(tolerances['LAP Indicator - 2020-2021']*100)) + "% the same number of students who have a Learning Acquisition Plan indicator. \n"
+            "After grouping attendance into three categories (Above 90%, 90-80%, and below 80%), every class within each grade level has a distribution of students in these categories within " + (str(tolerances['Attn % - 2020-2021']*100)) + "%. \n"
+            "Every class within each grade level has balanced achievement. The average of students' standardized test scores for each class is within " + (str(tolerances['IRLA-Score - 2020-2021']*100)) + "%. \n"
+            "All special education and highly capable students are clustered in accordance with your cluster file, and students' races are balanced across classrooms: every class with students of a race has at least " + str(AFFINITY_MIN) + " of them, and the number of students of each race differs by at most " + str(AFFINITY_SPREAD) + " between classes. \n")
+    return s
+
+def class_sheet_name(grade, n):
+    """Return the name of the sheet, or CSV file, holding class n (0 for the first) of an exit grade."""
+
+    return f'{grade} Class {n + 1}'
+
+class ClassListWriter:
+    """Writes class lists one grade at a time, as soon as each grade is solved, without holding earlier grades in memory.  An xlsx workbook is written in openpyxl's write-only mode, which streams rows to disk, and is saved when the writer is closed, including when a later grade fails inside a with block.  The csv format writes a folder with one file per sheet, each complete as soon as its grade is written.  Every class gets a sheet named by class_sheet_name(), and the SUMMARY_SHEET gets a row of grade_stats() per class."""
+
+    def __init__(self, path, output_format='xlsx'):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{output_format}'; use one of {', '.join(OUTPUT_FORMATS)}.")
+        self.path = path
+        self.output_format = output_format
+        self.grades = []
+        summary_header = ['Grade', 'Class', 'Students'] + STAT_COLUMNS
+        if output_format == 'xlsx':
+            self.workbook = Workbook(write_only=True)
+            self.summary = self.workbook.create_sheet(SUMMARY_SHEET)
+            self.summary.append(summary_header)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.write_csv(SUMMARY_SHEET, [summary_header])
+
+    def __enter__(self):
+        return self
 
-    print(s)
-    save_xlsx(next_yrs_classes, r'C:\Users\derek\Documents\CityU\CS687_Capstone\Classroom Equity Folder\NextYrsClasses.xlsx' )
+    def __exit__(self, *exc):
+        self.close()
 
-# Clean data and divide students by grade 
-students_by_grade = initialize_data()
+    def write_csv(self, sheet_name, rows, mode='w'):
+        """Write rows to the CSV file standing in for one sheet."""
+
+        with open(os.path.join(self.path, sheet_name + '.csv'), mode, newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    def write_grade(self, grade, classes, stats):
+        """Write one grade's classes, a list of student dataframes like classes_from_labels() returns, and their grade_stats() to the summary."""
+
+        for n, students in enumerate(classes):
+            # Empty cells stay empty instead of being written as NaN.
+            values = students.astype(object).where(students.notna(), None)
+            rows = [[students.index.name or 'Stu ID'] + list(students.columns)]
+            rows += ([student_id] + list(row) for student_id, row in zip(students.index, values.itertuples(index=False)))
+            if self.output_format == 'xlsx':
+                sheet = self.workbook.create_sheet(class_sheet_name(grade, n))
+                for row in rows:
+                    sheet.append(row)
+            else:
+                self.write_csv(class_sheet_name(grade, n), rows)
 
-# Determine how many classes each grade level will form for next year.
-cls_per_grade = how_many_classes(students_by_grade)
+        summary = [[grade, n + 1, len(students)] + np.round(stats[n], 4).tolist() for n, students in enumerate(classes)]
+        if self.output_format == 'xlsx':
+            for row in summary:
+                self.summary.append(row)
+        else:
+            self.write_csv(SUMMARY_SHEET, summary, 'a')
+        self.grades.append(grade)
+
+    def write_assignments(self, students_df, grade, assignments, stats):
+        """Write one grade given its students' class numbers, as solve_school() hands them to on_grade."""
+
+        labels = assignments.to_numpy()
+        self.write_grade(grade, classes_from_labels(students_df.loc[assignments.index], labels, len(stats)), stats)
+
+    def close(self):
+        """Finish the output.  The workbook is only written to disk here."""
+
+        if self.output_format == 'xlsx' and self.workbook is not None:
+            self.workbook.save(self.path)
+            self.workbook = None
+
+def save_classes(students_df, assignments, path=OUTPUT_FILE, output_format='xlsx'):
+    """Write every solved grade's classes, given each student's class number as solve_school() returns them, with a ClassListWriter."""
+
+    store = build_student_store(students_df.loc[assignments.index])
+    labels = assignments.to_numpy()
+    with ClassListWriter(path, output_format) as writer:
+        for code, grade in enumerate(EXIT_GRADES):
+            members = np.flatnonzero(store['Grade'] == code)
+            if len(members):
+                n_classes = int(labels[members].max()) + 1
+                writer.write_assignments(students_df, grade, assignments.iloc[members], grade_stats(encode_grade(store[members]), labels[members], n_classes))
+
+def sheet_order(sheet_name):
+    """Sort key putting class sheets in exit grade order and class order, as a ClassListWriter writes them."""
+
+    grade, _, number = sheet_name.rpartition(' Class ')
+    return (EXIT_GRADES.index(grade) if grade in EXIT_GRADES else len(EXIT_GRADES), int(number) if number.isdigit() else 0, sheet_name)
+
+def read_class_sheets(path):
+    """Return every class sheet written by a ClassListWriter at path, a workbook or a folder of CSV files, by sheet name in the order they were written."""
+
+    if os.path.isdir(path):
+        names = sorted((name[:-len('.csv')] for name in os.listdir(path) if name.endswith('.csv')), key=sheet_order)
+        sheets = {name: pd.read_csv(os.path.join(path, name + '.csv'), index_col=0) for name in names}
+    else:
+        sheets = pd.read_excel(path, sheet_name=None, index_col=0)
+    sheets.pop(SUMMARY_SHEET, None)
+    return sheets
+
+def load_assignments(path=OUTPUT_FILE):
+    """Read class lists written by a ClassListWriter and return the student body they were formed from and each student's class number within their grade as a Series indexed by student ID, like solve_school() returns.  Classes are numbered in the order their sheets appear within each grade."""
+
+    classes = []
+    counts = {}
+    for sheet in read_class_sheets(path).values():
+        if sheet.empty:
+            continue
+
+        # Excel may hand back grades like '04' as numbers.
+        sheet['Grade'] = sheet['Grade'].astype(str).str.zfill(2)
+        grade = sheet['Grade'].iloc[0]
+        classes.append(sheet.assign(Class=counts.get(grade, 0)))
+        counts[grade] = counts.get(grade, 0) + 1
+
+    students = pd.concat(classes)
+    return students.drop(columns='Class'), students['Class']
+
+def parse_args(argv=None):
+    """Read the command line options for a batch run."""
+
+    parser = argparse.ArgumentParser(description="Form next year's balanced classes from a Synergy SIS export.")
+    parser.add_argument('--input', default=SCHOOL_FILE, help='SIS export to read (default: %(default)s)')
+    parser.add_argument('--output', default=OUTPUT_FILE, help='Excel file, or folder for --format csv, to write the class lists to (default: %(default)s)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='xlsx', help='write an Excel workbook or a folder of CSV files, one per class plus a summary (default: %(default)s)')
+    parser.add_argument('--classes', type=int, nargs='+', metavar='N', help='number of classes for each exit grade, in the order ' + ' '.join(EXIT_GRADES) + '; asked for interactively when left out')
+    parser.add_argument('--solver', choices=sorted(SOLVERS), default=SOLVER_MODE, help='solver to use (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=PARALLEL_WORKERS, help='worker processes for solving grades in parallel, 0 to solve them one after another (default: %(default)s)')
+    parser.add_argument('--seeds', type=int, default=RACING_SEEDS, help='seeded solver runs raced per grade when solving in parallel (default: %(default)s)')
+    parser.add_argument('--progress', action='store_true', help=f'print attempts per second and check failure rates every {PROGRESS_INTERVAL:g} seconds and after each grade')
+    parser.add_argument('--trace', metavar='PATH', help='write solver metrics snapshots to a .json or .csv trace file')
+    parser.add_argument('--check-only', action='store_true', help='only check whether every grade can be solved with these class counts and tolerances, without solving')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS', help='stop searching each grade after this many seconds and keep the best classes found')
+    parser.add_argument('--attempt-budget', type=int, metavar='N', help='stop searching each grade after this many attempts and keep the best classes found')
+    parser.add_argument('--seed', type=int, help='seed every random step, so the run can be repeated exactly (default: a fresh seed, which is printed)')
+    parser.add_argument('--checkpoint', metavar='PATH', help='save the progress of the search to PATH as grades are solved')
+    parser.add_argument('--resume', action='store_true', help='continue the run saved in --checkpoint instead of starting over')
+    parser.add_argument('--repair', metavar='PATH', help='update the classes saved in PATH for enrollment changes in --input, moving as few students as possible, instead of solving again')
+    args = parser.parse_args(argv)
+
+    if args.classes is not None and len(args.classes) != len(EXIT_GRADES):
+        parser.error(f'--classes needs one number for each of the {len(EXIT_GRADES)} exit grades')
+    return args
+
+def main(argv=None):
+    """This program accepts as input a file from a elementary school district's Student Identification System(SIS), randomly assigns student to classes for the next year, performs balance and cluster checking in accordance with user settings, then repeats until all balance and clustering are within tolerance. The program then writes next year's class lists to an Excel file for use by the school. For this prototype, a specific school collaborated with this project, and that school's district uses SIS software distributed by Synergy."""
+
+    args = parse_args(argv)
+    metrics = SolverMetrics(progress=args.progress) if args.progress or args.trace else None
+    config = {'solver': args.solver, 'workers': args.workers, 'seeds': args.seeds, 'metrics': metrics, 'time_budget': args.time_budget, 'attempt_budget': args.attempt_budget,
+              'seed': args.seed, 'checkpoint': args.checkpoint, 'resume': args.resume}
+
+    # Clean data and read the acceptable cluster patterns once, before any solving starts.
+    students = read_school_file(args.input)
+    load_cluster_rules()
+
+    # Repair saved classes for enrollment changes instead of forming new ones.
+    if args.repair:
+        previous_students, previous = load_assignments(args.repair)
+        assignments = repair_school(students, previous_students, previous)
+        delta = assignments.attrs['delta']
+        print(f"{len(delta['added'])} students added, {len(delta['removed'])} removed and {len(delta['changed'])} changed since {args.repair} was saved.")
+        for grade, ids in assignments.attrs['moved'].items():
+            print(f'{grade}: {len(ids)} students moved' + (': ' + ', '.join(map(str, ids)) if len(ids) else '.'))
+        if assignments.attrs['misses']:
+            print('Moving students could not bring every grade back within every check. These checks are still missed:')
+            print(format_misses(assignments.attrs['misses']))
+        save_classes(students, assignments, args.output, args.format)
+        return
+
+    # Determine how many classes each grade level will form for next year.
+    if args.classes is None:
+        gradegroups = group_by_grade(students)
+        cls_per_grade = dict(zip(EXIT_GRADES, how_many_classes([gradegroups[grade] for grade in EXIT_GRADES])))
+    else:
+        cls_per_grade = dict(zip(EXIT_GRADES, args.classes))
+
+    # Report grades that cannot be solved before any search starts.
+    report = feasibility_report(students, cls_per_grade)
+    if report:
+        print('Some grades cannot be divided into classes that pass every check:')
+        print(format_feasibility_report(report))
+        raise SystemExit(1)
+    if args.check_only:
+        print('No grade has a known problem with these class counts and tolerances.')
+        return
+
+    # Write each grade's classes as soon as it is solved, so the grades already solved are kept if a later one fails.
+    print('Attempting to solve every grade...')
+    with ClassListWriter(args.output, args.format) as writer:
+        on_grade = lambda grade, assignments, stats: writer.write_assignments(students, grade, assignments, stats)
+        assignments = solve_school(students, cls_per_grade, {**config, 'check_feasibility': False, 'on_grade': on_grade})
+
+    # A budget can run out before every check passes, so say which checks the saved classes miss.
+    if assignments.attrs['misses']:
+        print('The search budget ran out before every check passed. The best classes found miss these checks:')
+        print(format_misses(assignments.attrs['misses']))
+    else:
+        print(success_message())
+    print(f"Random seed: {assignments.attrs['seed']}. Run again with --seed {assignments.attrs['seed']} and the same settings to get the same classes.")
+    if args.trace:
+        metrics.write_trace(args.trace)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import Equitable_Classrooms as ec
+import synthetic_school as ss
+
+# School sizes, in students, benchmarked when none are given.
+SIZES = [100, 300, 1000, 3000, 10000]
+
+# Timed calls per stats or cluster check measurement, and how many times each measurement is repeated (the best run is kept).
+EVALUATIONS = 2000
+REPEAT = 3
+
+# Candidates per batch when timing batch_stats.
+BENCH_BATCH = 256
+
+
+def best_time(fn, repeat=REPEAT):
+    """Run fn repeat times and return the fastest run in seconds."""
+
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def largest_grade(school):
+    """Return the encoded students and class count of the school's largest grade, which the per-evaluation measurements use."""
+
+    store = ec.build_student_store(school['students'])
+    code = np.argmax(np.bincount(store['Grade'][store['Grade'] >= 0], minlength=len(ec.EXIT_GRADES)))
+    return ec.encode_grade(store[store['Grade'] == code]), int(school['classes'][ec.EXIT_GRADES[code]])
+
+def bench_ingestion(school, repeat=REPEAT):
+    """Time reading the school's export from Excel: a cold read that parses and caches it, and a warm read from the cache."""
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, 'export.xlsx')
+        ss.write_export(school['export'], path)
+
+        cold = []
+        for run in range(repeat):
+            cache_dir = os.path.join(workdir, f'cache{run}')
+            started = time.perf_counter()
+            ec.read_school_file(path, cache_dir)
+            cold.append(time.perf_counter() - started)
+        warm = best_time(lambda: ec.read_school_file(path, cache_dir), repeat)
+
+    return {'ingest_cold_s': min(cold), 'ingest_warm_s': warm}
+
+def bench_stats(encoded, n_classes, evaluations=EVALUATIONS, repeat=REPEAT, rng=None):
+    """Time one grade_stats evaluation, and one candidate's share of a batch_stats call, in microseconds."""
+
+    rng = np.random.default_rng(rng)
+    labels = [ec.split_labels(rng.permutation(len(encoded)), n_classes) for _ in range(evaluations)]
+    single = best_time(lambda: [ec.grade_stats(encoded, l, n_classes) for l in labels], repeat)
+
+    orders = np.argsort(rng.random((BENCH_BATCH, len(encoded))), axis=1)
+    batched = best_time(lambda: ec.batch_stats(encoded, orders, n_classes), repeat)
+
+    return {'stats_eval_us': single / evaluations * 1e6, 'batch_stats_per_candidate_us': batched / BENCH_BATCH * 1e6}
+
+def bench_checks(encoded, n_classes, evaluations=EVALUATIONS, repeat=REPEAT, rng=None):
+    """Time the tolerance and cluster checks of one division, one at a time and per candidate of a batch, in microseconds."""
+
+    rng = np.random.default_rng(rng)
+    stats = [ec.grade_stats(encoded, ec.split_labels(rng.permutation(len(encoded)), n_classes), n_classes) for _ in range(evaluations)]
+    single = best_time(lambda: [(ec.within_tolerances(s), ec.check_clusters(s), ec.affinity_diversity_check(s)) for s in stats], repeat)
+
+    batch = np.array(stats)
+    batched = best_time(lambda: (ec.tolerance_checks(batch), ec.batch_cluster_mask(batch), ec.batch_affinity_mask(batch)), repeat)
+
+    return {'checks_eval_us': single / evaluations * 1e6, 'batch_checks_per_candidate_us': batched / evaluations * 1e6}
+
+def bench_solve(school, solver, seed=None):
+    """Solve the whole school once, the way main() does, and return the time, attempts made and attempts per second.  With a seed, every run makes the same attempts, so solver changes can be compared on the same work."""
+
+    metrics = ec.SolverMetrics()
+    started = time.perf_counter()
+    ec.solve_school(school['students'], school['classes'], {'solver': solver, 'tolerances': school['tolerances'], 'metrics': metrics, 'seed': seed})
+    elapsed = time.perf_counter() - started
+    return {'solve_s': elapsed, 'solve_attempts': metrics.attempts, 'solve_attempts_per_second': metrics.attempts / elapsed}
+
+def run_benchmarks(sizes=SIZES, solver=ec.SOLVER_MODE, seed=0, repeat=REPEAT, solve=True):
+    """Benchmark a synthetic school of every size and return one flat result dictionary per size."""
+
+    results = []
+    for n_students in sizes:
+        rng = np.random.default_rng(seed)
+        school = ss.synthetic_school(n_students, seed)
+        ss.install_cluster_rules(school['rules'])
+        encoded, n_classes = largest_grade(school)
+
+        result = {'students': n_students, 'classes_per_grade': n_classes, 'solver': solver, 'seed': seed}
+        result.update(bench_ingestion(school, repeat))
+        result.update(bench_stats(encoded, n_classes, repeat=repeat, rng=rng))
+        result.update(bench_checks(encoded, n_classes, repeat=repeat, rng=rng))
+        if solve:
+            result.update(bench_solve(school, solver, seed))
+        results.append(result)
+    return results
+
+def print_results(results):
+    """Print the results as a table with one row per measurement and one column per school size."""
+
+    measures = [key for key in results[0] if key not in ('students', 'solver', 'seed')]
+    print(f"{'students':<32}" + ''.join(f"{result['students']:>14}" for result in results))
+    for measure in measures:
+        print(f'{measure:<32}' + ''.join(f'{result.get(measure, float("nan")):>14.4g}' for result in results))
+
+def main(argv=None):
+    """Benchmark ingestion, stats evaluation, cluster checks and full solves on synthetic schools of increasing size, print a table and optionally save the numbers as JSON for tracking regressions."""
+
+    parser = argparse.ArgumentParser(description='Benchmark the class solver on synthetic schools.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='school sizes in students (default: %(default)s)')
+    parser.add_argument('--solver', choices=sorted(ec.SOLVERS), default=ec.SOLVER_MODE, help='solver for the full solves (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic schools and the solver (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='repeats per timing, best kept (default: %(default)s)')
+    parser.add_argument('--no-solve', action='store_true', help='skip the full solves')
+    parser.add_argument('--output', metavar='PATH', help='write the results to a JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.solver, args.seed, args.repeat, not args.no_solve)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
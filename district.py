@@ -0,0 +1,180 @@
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import Equitable_Classrooms as ec
+
+# Schools solved at once, one per worker process.  0 solves them one after another in this process.
+DISTRICT_WORKERS = os.cpu_count() or 1
+
+# Students per class when a school's class counts are not given.
+CLASS_SIZE = 24
+
+# SIS exports picked up when a folder is given instead of a manifest.  The cluster workbooks that ship next to the sample export are not exports.
+EXPORT_EXTENSIONS = ('.xls', '.xlsx')
+SKIPPED_FILES = (os.path.basename(ec.CLUSTER_FILE), 'Race_Affinity_Clusters.xlsx')
+
+# The run report, written to the output folder with one row per school.
+REPORT_FILE = 'district_report.csv'
+REPORT_COLUMNS = ['school', 'export', 'output', 'status', 'students', 'classes', 'seconds', 'attempts', 'seed', 'problems']
+
+
+def read_manifest(path):
+    """Yield one job per school from a manifest CSV with a 'school' and an 'export' column and, optionally, one column of class counts per exit grade.  Export paths are relative to the manifest.  A blank class count is filled in from the grade's size.  Rows are read as they are needed, so a long manifest is never held in memory."""
+
+    folder = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            classes = {grade: int(row[grade]) for grade in ec.EXIT_GRADES if (row.get(grade) or '').strip()}
+            yield {'school': row['school'], 'export': os.path.join(folder, row['export']), 'classes': classes}
+
+def find_exports(folder):
+    """Yield one job per SIS export in a folder, named after the file, with every grade's class count filled in from its size.  The SKIPPED_FILES and Excel's lock files are left out."""
+
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(EXPORT_EXTENSIONS) and not name.startswith('~$') and name not in SKIPPED_FILES:
+            yield {'school': os.path.splitext(name)[0], 'export': os.path.join(folder, name), 'classes': {}}
+
+def read_jobs(source):
+    """Yield the schools to solve from a manifest CSV or a folder of exports."""
+
+    return find_exports(source) if os.path.isdir(source) else read_manifest(source)
+
+def fill_classes(students, classes, class_size=CLASS_SIZE):
+    """Return the class count of every exit grade the school has: the given count, or else about class_size students per class."""
+
+    sizes = {grade: len(grade_students) for grade, grade_students in ec.group_by_grade(students).items()}
+    return {grade: classes.get(grade, max(1, round(size / class_size))) for grade, size in sizes.items()}
+
+def share_cluster_rules(rules):
+    """Worker initializer: install the cluster rules the parent read, so no worker reads the cluster files again.  Each worker builds its own pattern tables from them on first use."""
+
+    # A forked worker is handed the parent's own dictionary, so copy it before clearing.
+    rules = dict(rules)
+    ec.CLUSTER_RULES.clear()
+    ec.CLUSTER_RULES.update(rules)
+    ec.CLUSTER_TABLES.clear()
+
+def run_school(job, output_dir, config, output_format='xlsx', class_size=CLASS_SIZE, cache_dir=ec.CACHE_DIR):
+    """Read, solve and write one school's classes and return its row of the run report.  A school that cannot be solved is reported instead of raised, so one bad export does not stop the district's run."""
+
+    started = time.perf_counter()
+    extension = '.xlsx' if output_format == 'xlsx' else ''
+    row = {'school': job['school'], 'export': job['export'], 'output': os.path.join(output_dir, job['school'] + extension),
+           'status': 'solved', 'students': 0, 'classes': 0, 'attempts': 0, 'seed': '', 'problems': ''}
+    metrics = ec.SolverMetrics()
+    try:
+        students = ec.read_school_file(job['export'], cache_dir)
+        classes = fill_classes(students, job['classes'], class_size)
+        row['students'] = sum(len(grade_students) for grade_students in ec.group_by_grade(students).values())
+        row['classes'] = sum(classes.values())
+
+        # Report impossible grades before any output is opened.
+        problems = ec.feasibility_report(students, classes, config['tolerances'])
+        if problems:
+            raise ec.InfeasibleError(ec.format_feasibility_report(problems))
+
+        # Write each grade as soon as it is solved, so the school's memory is freed grade by grade into the workbook.
+        with ec.ClassListWriter(row['output'], output_format) as writer:
+            on_grade = lambda grade, assignments, stats: writer.write_assignments(students, grade, assignments, stats)
+            assignments = ec.solve_school(students, classes, {**config, 'workers': 0, 'metrics': metrics, 'on_grade': on_grade, 'check_feasibility': False})
+        row['seed'] = assignments.attrs['seed']
+        if assignments.attrs['misses']:
+            row['status'] = 'budget'
+            row['problems'] = ec.format_misses(assignments.attrs['misses'])
+    except ec.InfeasibleError as error:
+        row['status'] = 'infeasible'
+        row['problems'] = str(error)
+    except Exception as error:
+        row['status'] = 'error'
+        row['problems'] = f'{type(error).__name__}: {error}'
+
+    row['attempts'] = metrics.attempts
+    row['seconds'] = round(time.perf_counter() - started, 3)
+    return row
+
+def run_district(jobs, output_dir, config=None, workers=DISTRICT_WORKERS, output_format='xlsx', class_size=CLASS_SIZE, cache_dir=ec.CACHE_DIR, report=None):
+    """Solve every school in jobs on a pool of worker processes, each school solved by one worker, and write one set of class lists per school into output_dir.  No more schools than there are workers are read or held at once, and jobs is only consumed as workers free up.  Each school's report row is passed to report, if given, as soon as it finishes; the rows are also returned in the order the schools finished."""
+
+    os.makedirs(output_dir, exist_ok=True)
+    config = ec.full_config(config)
+    rules = ec.CLUSTER_RULES if ec.CLUSTER_RULES else ec.load_cluster_rules()
+    rows = []
+
+    def finished(row):
+        rows.append(row)
+        if report is not None:
+            report(row)
+
+    if not workers:
+        for job in jobs:
+            finished(run_school(job, output_dir, config, output_format, class_size, cache_dir))
+        return rows
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=share_cluster_rules, initargs=(rules,)) as pool:
+        pending = set()
+        for job in jobs:
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished(future.result())
+            pending.add(pool.submit(run_school, job, output_dir, config, output_format, class_size, cache_dir))
+        for future in wait(pending).done:
+            finished(future.result())
+    return rows
+
+class ReportWriter:
+    """Writes the run report one school at a time, so the rows of schools already finished are on disk if the run stops."""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=REPORT_COLUMNS)
+        self.writer.writeheader()
+
+    def __call__(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+        print(f"{row['school']}: {row['status']}, {row['students']} students in {row['classes']} classes, {row['seconds']:.1f}s")
+
+    def close(self):
+        self.file.close()
+
+def summarize(rows, elapsed):
+    """Return a short summary of a district run: how many schools ended in each status, and the throughput."""
+
+    statuses = {}
+    for row in rows:
+        statuses[row['status']] = statuses.get(row['status'], 0) + 1
+    students = sum(row['students'] for row in rows)
+    return (f"{len(rows)} schools in {elapsed:.1f}s ({', '.join(f'{count} {status}' for status, count in sorted(statuses.items()))}), "
+            f"{len(rows) / elapsed:.2f} schools and {students / elapsed:.0f} students per second.")
+
+def main(argv=None):
+    """Form next year's classes for every school in a district without any questions: read a manifest of SIS exports and class counts, or a folder of exports, solve the schools on a pool of worker processes, and write each school's class lists and a run report into the output folder."""
+
+    parser = argparse.ArgumentParser(description="Form next year's balanced classes for every school in a district.")
+    parser.add_argument('source', help="manifest CSV with 'school' and 'export' columns and optional class counts per exit grade (" + ' '.join(ec.EXIT_GRADES) + '), or a folder of SIS exports')
+    parser.add_argument('--output-dir', default='district_classes', help='folder for the class lists and the run report (default: %(default)s)')
+    parser.add_argument('--format', choices=ec.OUTPUT_FORMATS, default='xlsx', help='write each school as an Excel workbook or a folder of CSV files (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=DISTRICT_WORKERS, help='schools solved at once, 0 to solve them one after another (default: %(default)s)')
+    parser.add_argument('--class-size', type=int, default=CLASS_SIZE, help='students per class for grades without a class count (default: %(default)s)')
+    parser.add_argument('--solver', choices=sorted(ec.SOLVERS), default=ec.SOLVER_MODE, help='solver to use (default: %(default)s)')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS', help='stop searching each grade after this many seconds and keep the best classes found')
+    parser.add_argument('--attempt-budget', type=int, metavar='N', help='stop searching each grade after this many attempts and keep the best classes found')
+    parser.add_argument('--seed', type=int, help="seed every school's search with this, so the run can be repeated exactly (default: a fresh seed per school, reported)")
+    args = parser.parse_args(argv)
+
+    config = {'solver': args.solver, 'time_budget': args.time_budget, 'attempt_budget': args.attempt_budget, 'seed': args.seed}
+    os.makedirs(args.output_dir, exist_ok=True)
+    report = ReportWriter(os.path.join(args.output_dir, REPORT_FILE))
+    started = time.perf_counter()
+    try:
+        rows = run_district(read_jobs(args.source), args.output_dir, config, args.workers, args.format, args.class_size, report=report)
+    finally:
+        report.close()
+    print(summarize(rows, time.perf_counter() - started))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Manager
+
+import Equitable_Classrooms as ec
+import district
+
+# Where the service listens.  It only answers on this computer unless told otherwise.
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Solves run at once, one per worker process.  The workers live as long as the service, so each keeps its cluster tables between jobs.
+SERVICE_WORKERS = district.DISTRICT_WORKERS
+
+# Rosters kept in memory, by content hash of their export, and finished results kept for repeat requests, least recently used dropped first.
+ROSTER_CACHE_SIZE = 8
+RESULT_CACHE_SIZE = 128
+
+# Seconds a finished job can still be looked up by its id before it is forgotten.  Its result stays in the result cache for repeat requests.
+JOB_EXPIRY = 600
+
+
+def request_key(roster_digest, classes, config):
+    """Return the cache key of a solve request: a hash of the roster's content hash, the class counts, and every setting that changes the classes, the seed included."""
+
+    settings = {'roster': roster_digest, 'classes': classes, 'solver': config['solver'], 'tolerances': config['tolerances'], 'seed': config['seed'],
+                'time_budget': config['time_budget'], 'attempt_budget': config['attempt_budget']}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def run_job(job_id, students, classes, config, progress):
+    """Worker entry point: solve one job's school and count its solved grades in the shared progress dictionary as they finish.  Returns the class numbers, the checks missed, the seed and the seconds taken."""
+
+    def on_grade(grade, assignments, stats):
+        progress[job_id] = progress[job_id] + 1
+
+    started = time.perf_counter()
+    assignments = ec.solve_school(students, classes, {**config, 'workers': 0, 'on_grade': on_grade})
+    return assignments, assignments.attrs['misses'], assignments.attrs['seed'], time.perf_counter() - started
+
+class SolverService:
+    """Keeps rosters, cluster rules and a pool of solver processes warm between requests.  submit() starts a solve and returns its job at once; a request identical to a finished one is answered from the result cache, and one identical to a job still running joins that job."""
+
+    def __init__(self, workers=SERVICE_WORKERS, roster_cache_size=ROSTER_CACHE_SIZE, result_cache_size=RESULT_CACHE_SIZE):
+        rules = ec.CLUSTER_RULES if ec.CLUSTER_RULES else ec.load_cluster_rules()
+        self.manager = Manager()
+        self.progress = self.manager.dict()
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=district.share_cluster_rules, initargs=(rules,))
+        self.lock = threading.Lock()
+        self.rosters = OrderedDict()
+        self.results = OrderedDict()
+        self.roster_cache_size = roster_cache_size
+        self.result_cache_size = result_cache_size
+        self.jobs = {}
+        self.running = {}
+
+    def roster(self, path):
+        """Return an export's converted students and content hash, read from disk only the first time that content is asked for."""
+
+        digest = ec.file_digest(path)
+        with self.lock:
+            if digest in self.rosters:
+                self.rosters.move_to_end(digest)
+                return self.rosters[digest], digest
+        students = ec.read_school_file(path, digest=digest)
+        with self.lock:
+            self.rosters[digest] = students
+            while len(self.rosters) > self.roster_cache_size:
+                self.rosters.popitem(last=False)
+        return students, digest
+
+    def submit(self, request):
+        """Start a solve for a request with an 'input' export, 'classes' per exit grade (a list in EXIT_GRADES order or a dictionary), and optionally 'tolerances', 'seed', 'solver', 'time_budget', 'attempt_budget' and an 'output' file to write the classes to.  Returns the job's view()."""
+
+        students, digest = self.roster(request.get('input', ec.SCHOOL_FILE))
+        classes = request['classes']
+        if not isinstance(classes, dict):
+            classes = dict(zip(ec.EXIT_GRADES, classes))
+        classes = {grade: int(n) for grade, n in classes.items()}
+        config = {'solver': request.get('solver', ec.SOLVER_MODE), 'tolerances': {**ec.TOLERANCES, **request.get('tolerances', {})}, 'seed': request.get('seed'),
+                  'time_budget': request.get('time_budget'), 'attempt_budget': request.get('attempt_budget')}
+        if config['solver'] not in ec.SOLVERS:
+            raise ValueError(f"Unknown solver '{config['solver']}'; use one of {', '.join(sorted(ec.SOLVERS))}.")
+        unknown = set(request.get('tolerances', {})) - set(ec.TOLERANCES)
+        if unknown:
+            raise ValueError(f"Unknown tolerance {', '.join(sorted(map(str, unknown)))}; use any of {', '.join(ec.TOLERANCES)}.")
+        key = request_key(digest, classes, config)
+
+        with self.lock:
+            self.prune()
+            job = {'id': uuid.uuid4().hex[:12], 'key': key, 'status': 'running', 'cached': False, 'grades': len([grade for grade in classes if grade in ec.EXIT_GRADES]),
+                   'submitted': time.time(), 'finished': None, 'output': request.get('output'), 'result': None, 'error': None}
+            # Only jobs that write an output file hold on to their roster, and only until it is written.
+            job['students'] = students if job['output'] else None
+            self.jobs[job['id']] = job
+            if key in self.results:
+                self.results.move_to_end(key)
+                job.update(status='writing' if job['output'] else 'done', cached=True, result=self.results[key], finished=None if job['output'] else time.time())
+            elif key in self.running:
+                job['joined'] = self.running[key]
+            else:
+                self.running[key] = job['id']
+                self.progress[job['id']] = 0
+                future = self.pool.submit(run_job, job['id'], students, classes, config, self.progress)
+                future.add_done_callback(lambda future, job=job: self.finish(job, future))
+
+        # A cached answer is returned at once, even when its classes still have to be written.
+        if job['cached'] and job['output']:
+            threading.Thread(target=self.write_output, args=(job,), daemon=True).start()
+        return self.view(job['id'])
+
+    def finish(self, job, future):
+        """Record a finished solve, cache its result and update every job that joined it."""
+
+        try:
+            assignments, misses, seed, seconds = future.result()
+            result = {'assignments': assignments, 'misses': misses, 'seed': seed, 'seconds': seconds}
+            error = None
+        except Exception as exc:
+            result, error = None, f'{type(exc).__name__}: {exc}'
+
+        with self.lock:
+            self.running.pop(job['key'], None)
+            self.progress.pop(job['id'], None)
+            if result is not None:
+                self.results[job['key']] = result
+                while len(self.results) > self.result_cache_size:
+                    self.results.popitem(last=False)
+            finished = [other for other in self.jobs.values() if other is job or other.get('joined') == job['id']]
+            for other in finished:
+                writing = result is not None and other['output']
+                other.update(status='failed' if error else 'writing' if writing else 'done', result=result, error=error, finished=None if writing else time.time())
+
+        for other in finished:
+            if result is not None and other['output']:
+                self.write_output(other)
+
+    def write_output(self, job):
+        """Write a finished job's classes to the output file it asked for, then mark the job done."""
+
+        try:
+            ec.save_classes(job['students'], job['result']['assignments'], job['output'])
+        except OSError as exc:
+            job['error'] = f'{type(exc).__name__}: {exc}'
+        with self.lock:
+            job['students'] = None
+            job['status'] = 'done'
+            job['finished'] = time.time()
+
+    def prune(self):
+        """Forget the jobs that finished more than JOB_EXPIRY seconds ago, so a long-running service does not keep every job it ever ran.  Called with the lock held."""
+
+        now = time.time()
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['finished'] is not None and now - job['finished'] > JOB_EXPIRY]:
+            del self.jobs[job_id]
+
+    def view(self, job_id, assignments=False):
+        """Raise KeyError for a job that is unknown or forgotten, else return what a client may see of it: its status, how many grades are solved, and once done, the seed, the checks missed and the seconds taken, with every student's class if assignments is true."""
+
+        with self.lock:
+            job = self.jobs[job_id]
+            source = job.get('joined', job_id)
+            view = {'id': job_id, 'status': job['status'], 'cached': job['cached'], 'grades': job['grades'], 'elapsed': round(time.time() - job['submitted'], 3)}
+            view['grades_done'] = job['grades'] if job['result'] is not None else self.progress.get(source, 0)
+            if job['error']:
+                view['error'] = job['error']
+            if job['result'] is not None:
+                view.update(seed=job['result']['seed'], misses=job['result']['misses'], seconds=round(job['result']['seconds'], 3))
+                if assignments:
+                    view['assignments'] = {str(student): int(n) for student, n in job['result']['assignments'].items()}
+        return view
+
+    def close(self):
+        """Stop the workers, dropping jobs that have not started."""
+
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Answers the service's JSON API: POST /jobs starts a solve, GET /jobs/<id> reports its progress and GET /jobs/<id>/result adds every student's class."""
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': f'No such endpoint: {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                return self.send_json(400, {'error': 'The request must be a JSON object.'})
+            self.send_json(202, self.server.service.submit(request))
+        except (ValueError, KeyError, TypeError, OSError) as exc:
+            self.send_json(400, {'error': f'{type(exc).__name__}: {exc}'})
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) in (2, 3) and parts[0] == 'jobs' and parts[2:] in ([], ['result']):
+            try:
+                return self.send_json(200, self.server.service.view(parts[1], assignments=parts[2:] == ['result']))
+            except KeyError:
+                pass
+        self.send_json(404, {'error': f'No such job or endpoint: {self.path}'})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host=HOST, port=PORT, workers=SERVICE_WORKERS):
+    """Run the service until interrupted."""
+
+    service = SolverService(workers)
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    print(f'Serving the class solver on http://{host}:{server.server_port} with {workers} workers.')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+def main(argv=None):
+    """Run the class solver as a local HTTP service, so repeated and concurrent requests share warm rosters, cluster tables and worker processes, and identical requests are answered from the result cache."""
+
+    parser = argparse.ArgumentParser(description='Serve the class solver over HTTP on this computer.')
+    parser.add_argument('--host', default=HOST, help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS, help='solves run at once (default: %(default)s)')
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers)
+
+if __name__ == "__main__":
+    main()
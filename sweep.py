@@ -0,0 +1,148 @@
+import argparse
+import csv
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import Equitable_Classrooms as ec
+import district
+
+# Command line names of the tolerances a sweep can vary, and the categories they set.
+TOLERANCE_OPTIONS = {'gender': 'Gender', 'iep': '504 - 2020-2021', 'lap': 'LAP Indicator - 2020-2021', 'attendance': 'Attn % - 2020-2021', 'irla': 'IRLA-Score - 2020-2021'}
+
+# Seconds each scenario is searched before its best division is reported instead.  A sweep is meant to compare settings, so no scenario may hold it up for long.
+SWEEP_TIME_BUDGET = 20.0
+
+# Scenarios solved at once, one per worker process.  0 solves them one after another in this process.
+SWEEP_WORKERS = district.DISTRICT_WORKERS
+
+# Every grade's encoded students, set once per worker by share_sweep_data() so scenarios only carry their settings.
+SWEEP_ENCODED = {}
+
+
+def class_choices(encoded_grades, choices=None, class_size=district.CLASS_SIZE):
+    """Return the class counts to try for every grade: the given list of counts per exit grade, or else one fewer, the same and one more than about class_size students per class."""
+
+    if choices is not None:
+        return {grade: counts for grade, counts in zip(ec.EXIT_GRADES, choices) if grade in encoded_grades}
+    rounded = {grade: max(1, round(len(encoded) / class_size)) for grade, encoded in encoded_grades.items()}
+    return {grade: sorted({max(1, n - 1), n, n + 1}) for grade, n in rounded.items()}
+
+def sweep_scenarios(encoded_grades, choices, tolerance_grid):
+    """Yield one scenario per grade, class count and combination of the tolerance values in tolerance_grid, which maps each tolerance's category to the values to try."""
+
+    for grade in encoded_grades:
+        for n_classes in choices[grade]:
+            for values in itertools.product(*tolerance_grid.values()):
+                yield {'grade': grade, 'classes': n_classes, 'tolerances': dict(zip(tolerance_grid, values))}
+
+def share_sweep_data(encoded_grades, rules):
+    """Worker initializer: keep the grades the parent encoded and its cluster rules, so every scenario a worker runs shares them."""
+
+    SWEEP_ENCODED.clear()
+    SWEEP_ENCODED.update(encoded_grades)
+    district.share_cluster_rules(rules)
+
+def scenario_row(scenario, status, seconds=0.0, attempts=0, spreads=None, problems=''):
+    """Return one row of the sweep table: the scenario's settings, then how it went, then the spread it reached in every tolerance category."""
+
+    row = {'grade': scenario['grade'], 'classes': scenario['classes']}
+    row.update({f'{option}_tol': scenario['tolerances'][category] for option, category in TOLERANCE_OPTIONS.items()})
+    row.update({'status': status, 'seconds': round(seconds, 3), 'attempts': attempts})
+    for index, option in enumerate(TOLERANCE_OPTIONS):
+        row[f'{option}_spread'] = '' if spreads is None else round(float(spreads[index]), 4)
+    row['problems'] = problems
+    return row
+
+def run_scenario(scenario, solver=ec.SOLVER_MODE, seconds=SWEEP_TIME_BUDGET, attempts=None, seed=None):
+    """Search one scenario within the budget and return its row: 'solved' if every check passed, else 'budget' with the checks its best division misses."""
+
+    encoded = SWEEP_ENCODED[scenario['grade']]
+    n_classes, tolerances = scenario['classes'], scenario['tolerances']
+    metrics = ec.SolverMetrics()
+    started = time.perf_counter()
+    labels, parts = ec.solve_grade_anytime(encoded, n_classes, solver, tolerances, seconds, attempts, metrics=metrics, rng=seed)
+    elapsed = time.perf_counter() - started
+
+    spreads = ec.stat_spreads(ec.grade_stats(encoded, labels, n_classes), list(TOLERANCE_OPTIONS.values()))
+    misses = ec.check_misses(parts, tolerances)
+    problems = ec.format_misses({scenario['grade']: misses}) if misses else ''
+    return scenario_row(scenario, 'budget' if misses else 'solved', elapsed, metrics.attempts, spreads, problems)
+
+def run_sweep(students_df, tolerance_grid, choices=None, solver=ec.SOLVER_MODE, seconds=SWEEP_TIME_BUDGET, attempts=None, workers=SWEEP_WORKERS, seed=None):
+    """Encode every grade once and try every scenario of class counts and tolerance values on it.  Scenarios analyze_feasibility() rules out are reported as 'infeasible' without a search; the rest are searched on a pool of worker processes that share the encoded grades.  Each scenario draws from its own random stream spawned from seed.  Returns the table's rows in grade, class count and tolerance order."""
+
+    store = ec.build_student_store(students_df)
+    encoded_grades = {grade: ec.encode_grade(store[store['Grade'] == code]) for code, grade in enumerate(ec.EXIT_GRADES) if (store['Grade'] == code).any()}
+    tolerance_grid = {category: tolerance_grid.get(category, [ec.TOLERANCES[category]]) for category in TOLERANCE_OPTIONS.values()}
+    scenarios = list(sweep_scenarios(encoded_grades, class_choices(encoded_grades, choices), tolerance_grid))
+    streams = np.random.SeedSequence(seed).spawn(len(scenarios))
+    rules = ec.CLUSTER_RULES if ec.CLUSTER_RULES else ec.load_cluster_rules()
+
+    # Rule out scenarios that cannot pass before any worker starts.
+    rows = [None] * len(scenarios)
+    searched = []
+    for index, scenario in enumerate(scenarios):
+        problems = ec.analyze_feasibility(encoded_grades[scenario['grade']], scenario['classes'], scenario['tolerances'])
+        if problems:
+            rows[index] = scenario_row(scenario, 'infeasible', problems='\n'.join(problems))
+        else:
+            searched.append(index)
+
+    if not workers:
+        share_sweep_data(encoded_grades, rules)
+        for index in searched:
+            rows[index] = run_scenario(scenarios[index], solver, seconds, attempts, streams[index])
+        return rows
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=share_sweep_data, initargs=(encoded_grades, rules)) as pool:
+        futures = {pool.submit(run_scenario, scenarios[index], solver, seconds, attempts, streams[index]): index for index in searched}
+        for future in as_completed(futures):
+            rows[futures[future]] = future.result()
+    return rows
+
+def print_table(rows):
+    """Print the sweep table with one line per scenario: its grade, class count and tolerances, the outcome, and the spread reached in every tolerance category."""
+
+    print(f"{'grade':<6}{'classes':>8}" + ''.join(f'{option + " tol":>16}' for option in TOLERANCE_OPTIONS) + f"{'status':>12}{'seconds':>10}" + ''.join(f'{option + " spread":>19}' for option in TOLERANCE_OPTIONS))
+    for row in rows:
+        spreads = ''.join(f"{row[f'{option}_spread']:>19}" for option in TOLERANCE_OPTIONS)
+        print(f"{row['grade']:<6}{row['classes']:>8}" + ''.join(f"{row[f'{option}_tol']:>16g}" for option in TOLERANCE_OPTIONS) + f"{row['status']:>12}{row['seconds']:>10.2f}" + spreads)
+
+def main(argv=None):
+    """Try a grid of class counts and tolerance settings on one school in a single run, and print a table of which combinations can be solved, how long each took and how balanced its classes came out, so settings can be chosen without a full run per try."""
+
+    parser = argparse.ArgumentParser(description='Try many class counts and tolerance settings on one school at once.')
+    parser.add_argument('--input', default=ec.SCHOOL_FILE, help='SIS export to read (default: %(default)s)')
+    parser.add_argument('--classes', nargs='+', metavar='N[,N...]', help='class counts to try for each exit grade, in the order ' + ' '.join(ec.EXIT_GRADES) + ', comma separated (default: around ' + str(district.CLASS_SIZE) + ' students per class)')
+    for option, category in TOLERANCE_OPTIONS.items():
+        parser.add_argument(f'--{option}', type=float, nargs='+', metavar='TOL', help=f'{category} tolerances to try (default: {ec.TOLERANCES[category]})')
+    parser.add_argument('--solver', choices=sorted(ec.SOLVERS), default=ec.SOLVER_MODE, help='solver to use (default: %(default)s)')
+    parser.add_argument('--time-budget', type=float, default=SWEEP_TIME_BUDGET, metavar='SECONDS', help='seconds to search each scenario (default: %(default)s)')
+    parser.add_argument('--attempt-budget', type=int, metavar='N', help='attempts to search each scenario')
+    parser.add_argument('--workers', type=int, default=SWEEP_WORKERS, help='scenarios solved at once, 0 to solve them one after another (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='seed for the searches, so the sweep can be repeated exactly (default: a fresh seed, which is printed)')
+    parser.add_argument('--output', metavar='PATH', help='also write the table to a CSV file')
+    args = parser.parse_args(argv)
+
+    choices = None if args.classes is None else [[int(n) for n in counts.split(',')] for counts in args.classes]
+    tolerance_grid = {category: getattr(args, option) for option, category in TOLERANCE_OPTIONS.items() if getattr(args, option)}
+    seed = ec.fresh_seed() if args.seed is None else args.seed
+
+    students = ec.read_school_file(args.input)
+    ec.load_cluster_rules()
+    started = time.perf_counter()
+    rows = run_sweep(students, tolerance_grid, choices, args.solver, args.time_budget, args.attempt_budget, args.workers, seed)
+    print_table(rows)
+    print(f'{len(rows)} scenarios in {time.perf_counter() - started:.1f}s. Random seed: {seed}.')
+
+    if args.output:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == "__main__":
+    main()
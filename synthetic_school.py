@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+import Equitable_Classrooms as ec
+
+# Share of students of each race.  Roughly the sample school's mix, with a few Native students so one race group is small enough to test the affinity minimum.
+RACE_SHARES = {'Asian': .06, 'Black': .14, 'Hispanic': .30, 'Native': .01, 'Multiple': .12, 'Pacific Islander': .09, 'White': .28}
+
+# Share of students who are in special education, highly capable, on a 504 plan, have a LAP indicator, or are boys.
+SPED_RATE = .12
+HCP_RATE = .06
+RATE_504 = .02
+LAP_RATE = .33
+MALE_RATE = .5
+
+# Attendance % is drawn from a normal distribution and capped at 100.  IRLA scores rise by IRLA_STEP per grade and some students have none.
+ATTENDANCE_MEAN = 90
+ATTENDANCE_SD = 6
+IRLA_MEAN = 1.0
+IRLA_STEP = 0.8
+IRLA_SD = 1.0
+IRLA_MISSING = .05
+
+# Students per class when choosing how many classes each grade forms.
+CLASS_SIZE = 24
+
+# Synthetic cluster rules put between CLUSTER_MIN and CLUSTER_MAX students of a category into every class that has any, like the school's cluster files do.
+CLUSTER_MIN = 2
+CLUSTER_MAX = 6
+
+
+def school_grade_sizes(n_students):
+    """Divide a school's students as evenly as possible over the exit grades and return a dictionary of students per exit grade."""
+
+    return dict(zip(ec.EXIT_GRADES, ec.class_sizes(n_students, len(ec.EXIT_GRADES)).tolist()))
+
+def classes_for(grade_sizes, class_size=CLASS_SIZE):
+    """Return how many classes each grade forms at about class_size students per class."""
+
+    return {grade: max(1, round(size / class_size)) for grade, size in grade_sizes.items()}
+
+def generate_students(grade_sizes, seed=None, sped_rate=SPED_RATE, hcp_rate=HCP_RATE, race_shares=RACE_SHARES):
+    """Return a synthetic SIS export with one row per student, written the way Synergy writes it ('Yes'/'No', 'Male'/'Female', attendance as a '%' string), with every column convert_attribs expects."""
+
+    rng = np.random.default_rng(seed)
+    grades = np.repeat(list(grade_sizes), list(grade_sizes.values()))
+    n_students = len(grades)
+    grade_steps = pd.Categorical(grades, categories=ec.EXIT_GRADES).codes
+
+    def yes_no(rate):
+        return np.where(rng.random(n_students) < rate, 'Yes', 'No')
+
+    races = rng.choice(list(race_shares), size=n_students, p=np.array(list(race_shares.values())) / sum(race_shares.values()))
+    attendance = np.minimum(rng.normal(ATTENDANCE_MEAN, ATTENDANCE_SD, n_students), 100)
+    irla = np.round(np.maximum(rng.normal(IRLA_MEAN + IRLA_STEP * grade_steps, IRLA_SD), 0), 1)
+    irla[rng.random(n_students) < IRLA_MISSING] = np.nan
+
+    return pd.DataFrame({'Name': np.nan,
+                         'Stu ID': 100000 + rng.permutation(n_students),
+                         'School': np.nan,
+                         'Grade': grades,
+                         'Race': races,
+                         'SPED': yes_no(sped_rate),
+                         'Attn % - 2020-2021': [f'{a:.2f}%' for a in attendance],
+                         'IRLA-Score - 2020-2021': irla,
+                         'HCP - 2020-2021': yes_no(hcp_rate),
+                         '504 - 2020-2021': yes_no(RATE_504),
+                         'Gender': np.where(rng.random(n_students) < MALE_RATE, 'Male', 'Female'),
+                         'LAP Indicator - 2020-2021': yes_no(LAP_RATE)})
+
+def write_export(students, path):
+    """Write a synthetic export to an Excel file laid out like the SIS export, with the column headers on row 11, so read_school_file can read it."""
+
+    students.to_excel(path, startrow=10, index=False)
+
+def synthetic_patterns(total, n_classes):
+    """Return the acceptable sorted patterns for placing total students of one category into n_classes classes: every even split over any number of classes that keeps each non-empty class between CLUSTER_MIN and CLUSTER_MAX, or an even split over every class when there are too many students for that."""
+
+    if total < CLUSTER_MIN:
+        return {(0,) * (n_classes - 1) + (total,)}
+
+    patterns = set()
+    for used in range(1, n_classes + 1):
+        if CLUSTER_MIN * used <= total <= CLUSTER_MAX * used:
+            patterns.add(tuple(sorted([0] * (n_classes - used) + ec.class_sizes(total, used).tolist())))
+    if not patterns:
+        patterns.add(tuple(sorted(ec.class_sizes(total, n_classes).tolist())))
+    return patterns
+
+def synthetic_cluster_rules(students, classes_per_grade):
+    """Build cluster rules covering a converted synthetic school: patterns for every class count and clustered category total that actually occurs, in the same shape as Equitable_Classrooms.CLUSTER_RULES.  Race groups follow the solver's affinity rule and need no patterns."""
+
+    rules = {ec.CLUSTER_FILE: {}}
+    for grade, students_in_grade in ec.group_by_grade(students).items():
+        n_classes = int(classes_per_grade[grade])
+        for category in ec.CLUSTERED_CATEGORIES:
+            rules[ec.CLUSTER_FILE].setdefault(n_classes, set()).update(synthetic_patterns(int(students_in_grade[category].sum()), n_classes))
+    return rules
+
+def install_cluster_rules(rules):
+    """Install the school's cluster rules with a synthetic school's patterns added to every class count they cover.  The school's own patterns are kept, and patterns installed for an earlier synthetic school are dropped."""
+
+    ec.load_cluster_rules()
+    for cluster_file, by_classes in rules.items():
+        for n_classes, patterns in by_classes.items():
+            ec.CLUSTER_RULES[cluster_file][n_classes] = ec.CLUSTER_RULES[cluster_file].get(n_classes, set()) | patterns
+    ec.CLUSTER_TABLES.clear()
+
+def synthetic_school(n_students, seed=None, class_size=CLASS_SIZE, sped_rate=SPED_RATE, hcp_rate=HCP_RATE, race_shares=RACE_SHARES, tolerances=None):
+    """Generate a synthetic school of n_students and return a dictionary with its raw 'export', the 'students' converted by convert_attribs, the 'classes' per exit grade, cluster 'rules' covering it, and the 'tolerances' to solve it with."""
+
+    grade_sizes = school_grade_sizes(n_students)
+    export = generate_students(grade_sizes, seed, sped_rate, hcp_rate, race_shares)
+    students = ec.convert_attribs(export.set_index('Stu ID'))
+    classes = classes_for(grade_sizes, class_size)
+
+    return {'export': export,
+            'students': students,
+            'classes': classes,
+            'rules': synthetic_cluster_rules(students, classes),
+            'tolerances': dict(ec.TOLERANCES if tolerances is None else tolerances)}